@@ -37,16 +37,70 @@ __email__ = 'sebastian@sipsolutions.net'
 __all__ = ['_data', '_qtell', 'status', '_tells', 'qtelldummy', 'misc', 'parser', 'icsbot']
 
 
-import time, socket, re, datetime
+# Only what every bot needs is imported here, optional things (socket, pytz,
+# misc.regex, ...) are imported on first use to keep startup fast.
+import time, re, itertools, datetime
+from collections import deque
 
-try:
-    import pytz
-    TZINFO = pytz.timezone('UTC')
-except ImportError:
-    print 'No pytz available, times will be naive datetimes.'
-    TZINFO = None
+import _data, _blocks, _dispatch, _framer, _output, _timer, tells
+
+_TZINFO = []
+
+def get_tzinfo():
+    """Return the UTC timezone of pytz or None if pytz is not available.
+    pytz is only imported when this is first called.
+    """
+    if not _TZINFO:
+        try:
+            import pytz
+            _TZINFO.append(pytz.timezone('UTC'))
+        except ImportError:
+            print 'No pytz available, times will be naive datetimes.'
+            _TZINFO.append(None)
+    return _TZINFO[0]
+
+
+class _LazyTzinfo(datetime.tzinfo):
+    """Stands in for the old module level TZINFO (pytz's UTC) without
+    importing pytz. Deprecated, use get_tzinfo() instead.
+    """
+
+    def utcoffset(self, dt):
+        return datetime.timedelta(0)
+
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+
+    def tzname(self, dt):
+        return 'UTC'
+
+
+    def __getattr__(self, name):
+        # pytz methods like localize and normalize.
+        return getattr(get_tzinfo(), name)
+
+
+    def __repr__(self):
+        return '<UTC>'
+
+# Deprecated, kept for old callers, use get_tzinfo().
+TZINFO = _LazyTzinfo()
+
+
+def _encode(command):
+    """Commands are queued as (UTF-8) byte strings, so that a flush can join
+    unicode and str commands.
+    """
+    if type(command) is unicode:
+        return command.encode('utf-8')
+    return str(command)
+
+
+# Commands which are remembered to send them again after reconnecting.
+_SETTINGS = ('set ', 'iset ')
 
-import _data, tells, misc.regex
 
 class IcsBot(object):
     """This is the base class to handle the connection (and timer).
@@ -62,8 +116,9 @@ class IcsBot(object):
     
     There is one more thing available for you which can be handy:
         o Use timer(time_in_epoch, function) to have a specific function
-           be called when the time is reached. I am not too happy with
-           the implementation, but I think its the best you will get.
+           be called when the time is reached, or repeat(seconds, function)
+           to have it called regularly. Both return a handle which can be
+           cancelled.
 
     NOTES:
         o The function to first register, is the function that will
@@ -75,6 +130,8 @@ class IcsBot(object):
            
     Some other variables:
         o self.READ_SIZE: amount of data the socket tries to read at once.
+           During bursts (who, games) this doubles up to self.MAX_READ_SIZE
+           (default 65536) and shrinks back once they are over.
         o self.TIMEOUT: default timeout on the socket (Modified for the
            timer implementation). Set to None if your connection is stable,
            otherwise I will consider the connection dead when the timeout
@@ -82,38 +139,105 @@ class IcsBot(object):
            quiet)
         o self.ics: The actual socket being used (when connected).
         o self.block_code: The current block code gotten or None
+        o self.BLOCK_WINDOW: Maximum number of executes waiting for their reply
+           (default 100). Further executes are queued and send when replies
+           come in.
+        o self.OFFLOAD_WORKERS: Number of worker threads for offloaded
+           handlers (default 4), see offload.
+        o self.EXECUTE_TIMEOUT: Default timeout for execute in seconds, or
+           None (default). See execute_timeout.
+        o self.RECONNECT_DELAY, self.RECONNECT_MAX_DELAY: First and maximum
+           wait in seconds before reconnecting (default 1 and 300), the wait is
+           doubled after each failed try. See run_forever.
+        o self.output_stats: Dictionary with the number of flushes, commands
+           and bytes send in total and in the last flush (last_commands,
+           last_bytes). Everything send is buffered and written at once
+           after each parse cycle or timer run.
+        o self.SEND_RATE, self.SEND_BURST: Outgoing commands are paced with a
+           token bucket so that bursts do not trip the FICS flood protection.
+           At most SEND_BURST commands (default 50) are written at once, and
+           after that SEND_RATE commands per second (default None, which
+           writes everything right away; ie. 10 to turn pacing on). The
+           timeout of an execute only starts when it is written. Commands
+           wait in three queues:
+           'interactive' (send, the default), 'execute' (execute, request)
+           and 'bulk'; a queue is only written when the ones before it are
+           empty. See output_queue_stats.
     
     If ptime is set, IcsBot.fics_time will be the time (hour and minute) when
     the last command was gotten. Else it is None. The bot currently sets the
     timezone to GMT for simplicity.
     """
 
-    def __init__(self, qtell_dummy=False, qtell_width=78, interface='seberg\'s base bot.', unmatched_log=None, tell_logger=None, help_command='help'):
+    def __init__(self, qtell_dummy=False, qtell_width=78, interface='seberg\'s base bot.', unmatched_log=None, tell_logger=None, help_command='help', data_sets=None):
         """Optional arguments:
             o qtell_dummy=False. Set to true if qtells are not possible.
             o qtell_width=78. Default Qtell widths. (ignored with dummy.)
             o interface="seberg's base bot." FICS interface variable.
             o tell_logger = Function which will be used to log all tells to the
                 bot. IE. pass sys.stdout.write to print, (default no logging).
+            o unmatched_log = Object with a write method, which gets all
+                blocks that were not matched by anything. Use
+                misc.logsink.RotatingLog to not block on the disk.
+            o data_sets = Dictionary name -> Data (or None) of data sets
+                shared with other bots (see multiplex.Multiplexer). The
+                dictionary itself is shared, a None entry is created by
+                the first bot using it with its main_key and buffer size.
+                They are never replaced by self[name, main_key], asking
+                for a different main_key raises a ValueError.
         """
-        self._buffer = ''
         # Initialize stupid to get around having to check later.
-        self._timed = []
-        self._registered = []
+        self._timers = _timer.TimerHeap()
+        self._registered = _dispatch.Dispatcher()
         
         self.handle = None
         self.tags = None
 
         self.READ_SIZE = 2048
+        self.MAX_READ_SIZE = 65536
+        # The current (adaptive) size of a read, None for self.READ_SIZE.
+        self._read_size = None
         self.TIMEOUT = 300
         
+        self.OFFLOAD_WORKERS = 4
+        self.OFFLOAD_POLL = 0.05
+        self._offload = None
+        # function -> [offloaded function, ...] registered with reg_comm.
+        self._offloaded = {}
+        
         self._prompt = re.compile('\n\r(?:(\d\d):(\d\d)_)?fics% ')
+        self._framer = _framer.PromptFramer(self._prompt, tzinfo=get_tzinfo)
 
         self._data_sets = {}
+        # name -> Data or None, shared with other bots (see data_sets).
+        if data_sets is None:
+            data_sets = {}
+        self._shared_sets = data_sets
         self._qtell_dummy = qtell_dummy
         
-        self._used_blocks = set()
+        self.BLOCK_WINDOW = 100
+        self.EXECUTE_TIMEOUT = None
+        
+        self.RECONNECT_DELAY = 1
+        self.RECONNECT_MAX_DELAY = 300
+        # set/iset name -> (order, command) of everything set so far, these
+        # are send again when reconnecting. And the functions to call after a
+        # reconnect (see reg_reconnect).
+        self._settings = {}
+        self._settings_order = itertools.count()
+        self._on_reconnect = []
+        self._was_connected = False
+        
+        self._block_ids = _blocks.BlockIds()
+        # block id -> _blocks.Execute waiting for its reply, and the executes
+        # waiting for a free slot in the window.
         self._block_funcs = {}
+        self._block_queue = deque()
+        # command -> _blocks.Result for request. In flight ones and the ones
+        # kept for their ttl as (expires, result).
+        self._requests = {}
+        self._request_cache = {}
+        self.request_stats = {'requests': 0, 'executed': 0, 'coalesced': 0, 'cached': 0}
         self._block_regex = re.compile('^\x15(?P<id>\d+)\x16(?P<code>\d+)\x16(?P<data>.*)$', re.DOTALL)
         
         if not qtell_dummy:
@@ -130,22 +254,41 @@ class IcsBot(object):
 
         self.send = self._store_send
         self.execute = self._store_execute
+        self._request = self._store_request
         
         self.fics_time = None
         self.block_code = None
         
         self.unmatched_log = unmatched_log
+        # Set to a misc.replay.Recorder (or anything with record(data)) to
+        # record everything read from FICS.
+        self.recorder = None
+        # See enable_metrics.
+        self.metrics = None
+        # The multiplex.Multiplexer serving this bot, if any.
+        self._multiplexer = None
+        
+        # Everything send is collected here and written by _flush after each
+        # parse cycle or timer run (as far as SEND_RATE allows).
+        self._output = _output.OutputQueue()
+        self.SEND_RATE = None
+        self.SEND_BURST = 50
+        self.output_stats = {'flushes': 0, 'commands': 0, 'bytes': 0, 'last_commands': 0, 'last_bytes': 0}
         
         self.send_after=[('normal', 'iset nowrap 1'), ('normal', 'set interface %s' % interface), ('normal', 'set seek 0'), ('normal', 'iset defprompt 1'), ('normal', 'set tzone GMT')]
 
 
-    def send(self, obj):
+    def send(self, obj, priority='interactive'):
         """Send data to FICS. Accepts one string OR iteratable item that
         gives strings. Each string should be one line, a newline is
         appended automatically.
         (This function does not actually exist as such, but is defined after
         creation to the approriate send function.)
         
+        priority can be 'interactive' (default), 'execute' or 'bulk'. Use
+        'bulk' for large amounts of commands that are not in a hurry, so that
+        they do not delay replies to users (see SEND_RATE).
+        
         NOTE: Use iterables to send more then one command. Using \\n will
             NOT work, because of block.
         """
@@ -166,7 +309,7 @@ class IcsBot(object):
         pass
     
 
-    def _send(self, obj):
+    def _send(self, obj, priority='interactive'):
         """Send data to FICS. Accepts one string OR iteratable item that
         gives strings. Each string should be one line, a newline is
         appended automatically.
@@ -180,10 +323,50 @@ class IcsBot(object):
         if not obj:
             return
         elif type(obj) == str or type(obj) == unicode:
-            self.ics.send('1 ' + obj + '\n')
+            obj = _encode(obj)
+            if obj.startswith(_SETTINGS):
+                self._remember_setting(obj)
+            self._output.append(priority, '1 ' + obj + '\n')
         else:
+            lines = []
             for command in obj:
-                self.ics.send('1 ' + str(command) + '\n')    
+                command = _encode(command)
+                if command.startswith(_SETTINGS):
+                    self._remember_setting(command)
+                lines.append('1 ' + command + '\n')
+            self._output.extend(priority, lines)
+    
+    
+    def _remember_setting(self, command):
+        """Remember a set/iset command, so that it is send again after
+        reconnecting. Only the last one for each variable is kept.
+        """
+        name = ' '.join(command.lower().split(None, 2)[:2])
+        self._settings[name] = (self._settings_order.next(), command)
+    
+    
+    def _flush(self, force=False):
+        """Write everything that was send during this parse cycle, timer or
+        handler to the socket at once (as much as SEND_RATE allows, or all
+        of it if force is given).
+        """
+        if not self._output:
+            return
+        lines, executes = self._output.take(self.SEND_RATE, self.SEND_BURST, force)
+        if not lines:
+            return
+        data = ''.join(lines)
+        commands = len(lines)
+        self.ics.sendall(data)
+        for execute in executes:
+            self._written(execute)
+        
+        stats = self.output_stats
+        stats['flushes'] += 1
+        stats['commands'] += commands
+        stats['bytes'] += len(data)
+        stats['last_commands'] = commands
+        stats['last_bytes'] = len(data)
     
     
     def _execute(self, command, handler, *args, **kwargs):
@@ -197,21 +380,136 @@ class IcsBot(object):
         Further *args and **kwargs are given to the handler function, thus it
         should take handler(data, *args, **kwargs).
         """
-        #print 'sending:', repr(obj)
+        self._submit(_blocks.Execute(command, handler, args, kwargs, self.EXECUTE_TIMEOUT))
+    
+    
+    def execute_priority(self, priority, command, handler, *args, **kwargs):
+        """Same as execute, but the command is send with the given priority
+        ('interactive', 'execute' or 'bulk') instead of 'execute'. See
+        SEND_RATE.
+        """
+        execute = _blocks.Execute(command, handler, args, kwargs, self.EXECUTE_TIMEOUT)
+        execute.priority = priority
+        self._request(execute)
+    
+    
+    def execute_timeout(self, timeout, on_error, command, handler, *args, **kwargs):
+        """Same as execute, but if there is no reply within timeout seconds
+        (None for no timeout) after the command was send, the handler is
+        dropped and on_error(command, *args, **kwargs) is called instead. If
+        on_error is None a warning is printed. Like for handlers, what on_error
+        returns is send.
         
-        i = 0
-        for i in xrange(2,1000):
-            if i not in self._used_blocks:
-                self._used_blocks.add(i)
-                break
-        else:
-            raise Exception('More then 999 commands executed (and no result gotten), quitting, as this is most likely a (spammy) bug. If you do need more, check the code.')
+        execute uses self.EXECUTE_TIMEOUT (default None) and no on_error.
+        """
+        self._request(_blocks.Execute(command, handler, args, kwargs, timeout, on_error))
+    
+    
+    def request(self, command, ttl=0, timeout=None, priority='execute'):
+        """Execute a command and return a Result for its reply, use
+        result.add_callback(handler, *args, **kwargs) to get it. Unlike
+        execute, requests for a command that is already waiting for its reply
+        are merged, so that one reply is given to all of them. If ttl is
+        given, the reply is also used for the same command for ttl seconds
+        after it came in. timeout is the same as for execute_timeout, if
+        it is hit the callbacks get None and result.failed is True. priority
+        is the same as for execute_priority.
+        
+        NOTE: Only use ttl for commands where a slightly old reply is fine,
+            and use the same ttl for all requests of a command.
+        """
+        self.request_stats['requests'] += 1
+        
+        cached = self._request_cache.get(command)
+        if cached is not None:
+            if cached[0] > time.time():
+                self.request_stats['cached'] += 1
+                return cached[1]
+            del self._request_cache[command]
+        
+        result = self._requests.get(command)
+        if result is not None:
+            self.request_stats['coalesced'] += 1
+            return result
+        
+        self.request_stats['executed'] += 1
+        result = _blocks.Result(self, command)
+        self._requests[command] = result
+        execute = _blocks.Execute(command, self._request_done, (result, ttl), {}, timeout, self._request_failed)
+        execute.priority = priority
+        result._execute = execute
+        self._request(execute)
+        return result
+    
+    
+    def _request_done(self, data, result, ttl):
+        t = time.time()
+        del self._requests[result.command]
+        if ttl:
+            if len(self._request_cache) > 100:
+                # Drop old ones, so that this does not grow forever.
+                for command, cached in self._request_cache.items():
+                    if cached[0] <= t:
+                        del self._request_cache[command]
+            self._request_cache[result.command] = (t + ttl, result)
+        result._resolve(data, self.block_code, t)
+    
+    
+    def _request_failed(self, command, result, ttl):
+        del self._requests[command]
+        result._resolve(None, None, time.time(), failed=True)
+    
+    
+    def _submit(self, execute):
+        """Send the execute with a free block id, or queue it if there are
+        already BLOCK_WINDOW executes waiting for their reply.
+        """
+        if len(self._block_funcs) >= self.BLOCK_WINDOW or not self._block_ids:
+            self._block_queue.append(execute)
+            return
+        
+        execute.id, execute.generation = self._block_ids.allocate()
+        self._output.append(execute.priority, ('%s ' % execute.id) + _encode(execute.command) + '\n', execute)
+        self._block_funcs[execute.id] = execute
+    
+    
+    def _written(self, execute):
+        """The execute was written, start its timeout (and the clock for the
+        round trip in the metrics).
+        """
+        if self._block_funcs.get(execute.id) is not execute:
+            # Timed out or replied to already (can only happen if the
+            # queue was kept over a reconnect).
+            return
+        execute.sent = time.time()
+        if execute.timeout is not None:
+            execute.timer = self.timer(execute.sent + execute.timeout, self._execute_timed_out, execute.id, execute.generation)
+    
+    
+    def _release_block(self, id_):
+        """Free the block id and send queued executes."""
+        execute = self._block_funcs.pop(id_)
+        if execute.timer is not None:
+            execute.timer.cancel()
+        self._block_ids.release(id_)
         
-        self.ics.send(('%s ' % i) + command + '\n')
-        self._block_funcs[i] = (handler, args, kwargs)
+        while self._block_queue and len(self._block_funcs) < self.BLOCK_WINDOW and self._block_ids:
+            self._submit(self._block_queue.popleft())
+        return execute
+    
+    
+    def _execute_timed_out(self, id_, generation):
+        # The id might have been replied to and reused in the meantime.
+        if id_ not in self._block_funcs or self._block_funcs[id_].generation != generation:
+            return
+        execute = self._release_block(id_)
+        if execute.on_error is None:
+            print 'Warning: No reply for "%s" within %s seconds.' % (execute.command, execute.timeout)
+            return
+        return execute.on_error(execute.command, *execute.args, **execute.kwargs)
     
     
-    def _store_send(self, obj):
+    def _store_send(self, obj, priority='interactive'):
         """Command that stored things to send to the server, if we are not
         yet connected.
         SEND USUALLY DOES:
@@ -219,38 +517,66 @@ class IcsBot(object):
         gives strings. Each string should be one line, a newline is
         appended automatically.
         """
-        self.send_after += [('normal', obj)]
+        self.send_after += [('normal', obj, priority)]
 
 
     def _store_execute(self, command, handler, *args, **kwargs):
         """Command that stored things to execute on the server, if we are not
         yet connected. further args and kwargs are passed on to the function.
         """
-        self.send_after += [('block', command, handler, args, kwargs)]       
+        self._store_request(_blocks.Execute(command, handler, args, kwargs, self.EXECUTE_TIMEOUT))
+
+
+    def _store_request(self, execute):
+        """Store an _blocks.Execute until we are connected."""
+        self.send_after += [('block', execute)]       
 
     
     def __getitem__(self, item):
         """Create or get a data item. If a tuple is given (ie, not ['users'],
         but ['sgames', 'game'], then the second item will be the new main_key
         of the data item (see corresponding class). In this case it will always
-        be overwritten). A possible third item sets the buffer size, not that
-        this should really matter for anything much *item[1:] is handed on.
+        be overwritten). A possible third item sets the buffer size, a
+        fourth the buffer ttl and a fifth compact (see Data), *item[1:] is
+        handed on.
         """
         if type(item) is tuple:
-            self._data_sets[item[0].lower()] = _data.Data(*item[1:])
-            return self._data_sets[item[0].lower()]
+            name, args = item[0].lower(), item[1:]
+        else:
+            name, args = item.lower(), ()
+        
+        if name in self._shared_sets:
+            data_set = self._shared_sets[name]
+            if data_set is None:
+                data_set = self._shared_sets[name] = _data.Data(*args)
+            elif args and args[0] != data_set.main_key:
+                raise ValueError('The shared data set %r uses the main_key %r, not %r.' % (name, data_set.main_key, args[0]))
+            return data_set
+        
+        if args:
+            self._data_sets[name] = _data.Data(*args)
+            return self._data_sets[name]
         try:
-            return self._data_sets[item.lower()]
+            return self._data_sets[name]
         except KeyError:
-            self._data_sets[item.lower()] = _data.Data()
-            return self._data_sets[item.lower()]
+            self._data_sets[name] = _data.Data()
+            return self._data_sets[name]
 
 
-    def reg_comm(self, REGEX, function):
+    def reg_comm(self, REGEX, function, prefix=None, offload=False):
         """register(regular expression object OR unparsed string, itself)
         Register a function to be parsed. The function must accept the
         corresponding match object as argument.
         
+        prefix can be given to tell the bot the leading token (everything
+        before the first space) that all blocks matching the regex start with,
+        ie. '<wa>'. Only blocks starting with it will be tried for this regex.
+        If not given, the bot tries to work it out from the regex itself, which
+        works for regexes like '^<wa> ...' and '^\\{Game ...'.
+        
+        If offload is True, the function is run in a worker thread, see
+        offload.
+        
         NOTE: The bot uses FICS blocking, but it does not matter for these
             regexes. Things that are matched through blocking (execute command)
             will not be matched with these regexes.
@@ -263,27 +589,93 @@ class IcsBot(object):
         if type(REGEX) is str:
             REGEX = re.compile(REGEX)
         
-        self._registered += [[REGEX, function]]
+        if offload:
+            offloaded = self.offload(function)
+            self._offloaded.setdefault(function, []).append(offloaded)
+            function = offloaded
+        self._registered.register(REGEX, function, prefix)
     
     
     def unreg_comm(self, function):
         """unreg_comm(function)
         Unregister a function (itself usually from being parsed.
-        (Loops through the all functions and deletes all occurences)
+        (Deletes all occurences)
         """
-        to_delete = []
-        # Get all indexes with the function:
-        for i in xrange(0, len(self._registered)):
-            if self._registered[i][1] == function:
-                to_delete += [i]
-                
-        # Reverse the list of occurences.
-        to_delete.reverse()
+        self._registered.unregister(function)
+        for offloaded in self._offloaded.pop(function, ()):
+            self._registered.unregister(offloaded)
+
+
+    def enable_metrics(self):
+        """Start collecting counters and latency histograms, see
+        _metrics.Metrics. Returns the Metrics object (also self.metrics), use
+        its dump() method to print a summary. Without metrics enabled there
+        is no overhead.
+        """
+        import _metrics
+        self.metrics = _metrics.Metrics()
+        self._registered.set_metrics(self.metrics)
+        return self.metrics
+
+
+    def disable_metrics(self):
+        """Stop collecting metrics."""
+        self.metrics = None
+        self._registered.set_metrics(None)
+
+
+    def offload(self, function, name=None):
+        """Return a function which runs function in a worker thread (there
+        are self.OFFLOAD_WORKERS threads). What it returns is send in the main
+        loop, in the order the functions were called. Use this for slow
+        handlers (database, file writes), so that they do not stall parsing.
         
-        # Delete the Occurences from the end, so that the indexing doesn't
-        # change.
-        for i in to_delete:
-            del self._registered[i]
+        offload_stats() gives the calls, queue depth and latency for each
+        function (by name, which defaults to the functions name).
+        
+        NOTE: The function runs in another thread. Return what to send
+            instead of calling self.send, and be careful with shared data.
+        """
+        if self._offload is None:
+            import _offload
+            self._offload = _offload.OffloadPool(self.OFFLOAD_WORKERS)
+        return self._offload.wrap(function, name)
+
+
+    def offload_stats(self):
+        """Return {name: stats} for offloaded functions, see
+        _offload.OffloadPool.
+        """
+        if self._offload is None:
+            return {}
+        return self._offload.stats()
+
+
+    def _collect_offloaded(self):
+        if self._offload is None:
+            return
+        results, error = self._offload.collect()
+        for result in results:
+            self.send(result)
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+
+    def output_queue_stats(self):
+        """Return {priority: stats} for the outgoing command queues (see
+        SEND_RATE). stats is a dictionary with the number of commands queued
+        right now, max_queued, sent and the total and maximum time commands
+        waited in the queue (wait, max_wait).
+        """
+        return self._output.stats()
+
+
+    def dispatch_stats(self):
+        """Return a dictionary of leading token -> [hits, misses] of the regex
+        dispatching. Blocks whose leading token no regex registered for are
+        counted with the None token.
+        """
+        return self._registered.stats()
 
 
     def connect(self, user='guest', password='', ics='freechess.org', port=5000):
@@ -293,6 +685,7 @@ class IcsBot(object):
         as those use the provided username. Overwrite them again after
         connection if you want something else.
         """
+        import socket
         try:
             del self.ics
         except AttributeError:
@@ -377,10 +770,20 @@ class IcsBot(object):
                 return        
         
         offset = data.find('**** Starting FICS session')
-        self._buffer = data[offset:]
+        self._attach(s, data[offset:])
+
+
+    def _attach(self, s, data):
+        """Start using the socket s, which is logged in. data is what was
+        read starting with "**** Starting FICS session".
+        """
+        import misc.regex
+        if self.recorder is not None:
+            self.recorder.record(data)
+        self._framer.reset(data)
 
         r = re.compile('\*\*\*\* Starting FICS session as (%s)(%s) \*\*\*\*' % (misc.regex.HANDLE, misc.regex.TAGS))
-        self.handle, self.tags = r.match(self._buffer).groups()
+        self.handle, self.tags = r.match(data).groups()
         self.ics = s
         self.ics.settimeout(self.TIMEOUT)
         
@@ -398,22 +801,139 @@ class IcsBot(object):
             else:
                 self.qtell.__class__.width = 370
         
-        s.send('iset block 1\n')
+        # This must go first, everything else is send with a block id.
+        self._output.clear()
+        self._output.append('interactive', 'iset block 1\n')
                 
         self.send = self._send
         self.execute = self._execute
+        self._request = self._submit
         for i in self.send_after:
             if i[0] == 'normal':
-                self.send(i[1])
+                self.send(*i[1:])
             else:
-                self.execute(i[1], i[2], *i[3], **i[4])
+                self._submit(i[1])
+        self.send_after = []
+        
+        if self._was_connected:
+            for function in self._on_reconnect:
+                self.send(function())
+        self._was_connected = True
+        self._flush()
+
+
+    def _disconnected(self):
+        """Forget the lost connection and go back to storing what is send.
+        The settings and all executes that did not get their reply yet are
+        stored to be send again when connecting. (Also if called again after
+        a failed connect, then the executes stored before are kept.)
+        """
+        try:
+            self.ics.close()
+            del self.ics
+        except AttributeError:
+            pass
+        
+        self.send = self._store_send
+        self.execute = self._store_execute
+        self._request = self._store_request
+        self._output.clear()
+        self._framer.reset()
+        self.block_code = None
+        
+        # Executes stored by an earlier call (the connect failed since).
+        stored = [entry[1] for entry in self.send_after if entry[0] == 'block']
+        
+        outstanding = sorted(self._block_funcs.values(), key=lambda execute: execute.queued)
+        for execute in outstanding:
+            if execute.timer is not None:
+                execute.timer.cancel()
+                execute.timer = None
+            self._block_ids.release(execute.id)
+        self._block_funcs = {}
+        outstanding.extend(self._block_queue)
+        self._block_queue.clear()
+        outstanding = stored + outstanding
+        
+        settings = sorted(self._settings.values())
+        self.send_after = [('normal', command) for order, command in settings]
+        self.send_after += [('block', execute) for execute in outstanding]
+        
+        # Requests whose execute is not waiting anymore would never get a
+        # reply, fail them instead of merging new requests into them.
+        waiting = set([id(execute) for execute in outstanding])
+        for command, result in self._requests.items():
+            if id(result._execute) not in waiting:
+                del self._requests[command]
+                result._resolve(None, None, time.time(), failed=True)
+
+
+    def reg_reconnect(self, function):
+        """Register a function to be called (without arguments) after the
+        bot connected again (see run_forever). What it returns is send. Use
+        it to bring state up to date that may have changed while the bot was
+        not connected. Settings (set/iset) and executes still waiting for
+        their reply are send again automatically.
+        """
+        self._on_reconnect.append(function)
+
+
+    def unreg_reconnect(self, function):
+        """Unregister a function registered with reg_reconnect."""
+        self._on_reconnect.remove(function)
+
+
+    def run_forever(self, user='guest', password='', ics='freechess.org', port=5000):
+        """Connect (if not connected yet) and run, reconnecting whenever the
+        connection is lost. Between tries the bot waits self.RECONNECT_DELAY
+        seconds, doubling the wait after each failure up to
+        self.RECONNECT_MAX_DELAY. The wait starts over once a connection
+        stayed up for RECONNECT_MAX_DELAY seconds.
+        
+        Only returns by raising ConnectionClosed if closed by us, nuked or
+        someone else logged in as us, InvalidLogin (except for a guest handle
+        being in use), or any error raised by a function.
+        """
+        import socket
+        delay = self.RECONNECT_DELAY
+        while True:
+            started = time.time()
+            try:
+                if not hasattr(self, 'ics'):
+                    self.connect(user, password, ics, port)
+                self.run()
+            except ConnectionClosed, e:
+                if e.value in ('Closed by us.', 'Nuked', 'Someone logged in as me.'):
+                    raise
+                reason = e
+            except InvalidLogin, e:
+                if e.value != 'Handle in use.':
+                    raise
+                reason = e
+            except socket.error, e:
+                reason = e
+            
+            self._disconnected()
+            if time.time() - started >= self.RECONNECT_MAX_DELAY:
+                delay = self.RECONNECT_DELAY
+            print 'Connection lost (%s), reconnecting in %s seconds.' % (reason, delay)
+            time.sleep(delay)
+            delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
 
 
     def close(self):
         """Close the connection and delete self.ics the hard way. Raises
         ConnectionClosed('Closed by us.')
+        
+        NOTE: When a Multiplexer serves this bot and a handler or timer of
+            another bot closes it, this only marks it and returns. The
+            multiplexer closes it after that handler returned.
         """
+        multiplexer = self._multiplexer
+        if multiplexer is not None and multiplexer._close_later(self):
+            return
         self.send('$quit')
+        self._flush(force=True)
         self.ics.close()
         del self.ics
         raise ConnectionClosed('Closed by us.')
@@ -424,9 +944,21 @@ class IcsBot(object):
         Register a function to be executed at a specific time. All args
         and kwargs are passed through to the function.
         Old times are quietly ignored (function will get executed later)
+        
+        Returns a timer handle, use handle.cancel() to remove the timer again.
         """
-        self._timed += [[epoch, function, args, kwargs]]
-        self._timed.sort()
+        return self._timers.add(epoch, function, args, kwargs, owner=self)
+
+
+    def repeat(self, interval, function, *args, **kwargs):
+        """repeat(interval_in_seconds, function, *args, **kwargs):
+        Register a function to be executed every interval seconds, starting
+        in interval seconds. If the bot is late, calls are not made up for.
+        
+        Returns a timer handle, use handle.cancel() to stop it.
+        """
+        assert interval > 0, 'The interval must be positive.'
+        return self._timers.add(time.time() + interval, function, args, kwargs, interval=interval, owner=self)
 
 
     def remove_timer(self, epoch, function, no_kwargs=False, *args, **kwargs):
@@ -435,30 +967,25 @@ class IcsBot(object):
         timed commands without checking the time.
         
         If no_kwargs is given, matches the function only for args.
+        Raises ValueError if epoch and kwargs are given and nothing matched.
+        
+        NOTE: This has to look at all timers, cancelling the handle returned
+            by timer() is much faster.
         """
-        if epoch is None and no_kwargs is True:
-            to_del = []
-            for i in xrange(0, len(self._timed)):
-                if self._timed[i][1] == function and self._timed[i][2] == args:
-                    to_del += i
-            for i in to_del:
-                del self._timed[i]
-        elif epoch is None:
-            to_del = []
-            for i in xrange(0, len(self._timed)):
-                if self._timed[i][1] == function and self._timed[i][2] == args and self._timed[i][3] == kwargs:
-                    to_del += i
-            for i in to_del:
-                del self._timed[i]
-        elif no_kwargs is True:
-            to_del = []
-            for i in xrange(0, len(self._timed)):
-                if self._timed[i][0] == epoch and self._timed[i][1] == function and self._timed[i][2] == args:
-                    to_del += i
-            for i in to_del:
-                del self._timed[i]                        
-        else:
-            self._timed.remove([epoch, function, args, kwargs])
+        removed = []
+        def match(timer):
+            if timer.function != function or timer.args != args:
+                return False
+            if epoch is not None and timer.epoch != epoch:
+                return False
+            if not no_kwargs and timer.kwargs != kwargs:
+                return False
+            removed.append(timer)
+            return True
+        
+        self._timers.remove(match)
+        if not removed and epoch is not None and not no_kwargs:
+            raise ValueError('No such timer.')
     
     
     def parse_block(self, data):
@@ -472,31 +999,41 @@ class IcsBot(object):
         data = data.strip()
         if not data:
             return
-        for (regex, function) in self._registered:
-            match = regex.match(data)
-            if match:
-                self.send(function(match))
-                break
-        
-        if self.unmatched_log is not None:
+        matched, result = self._registered.dispatch(data)
+        if matched:
+            self.send(result)
+        elif self.unmatched_log is not None:
             self.unmatched_log.write(data)
     
     
-    def _parse(self, string):
-        buf = self._buffer + string
+    def _read(self):
+        """Read from the socket, READ_SIZE bytes or more while FICS sends
+        large replies (see MAX_READ_SIZE). Returns the string read (empty if
+        the connection was closed).
+        """
+        # READ_SIZE and MAX_READ_SIZE may be changed at any time.
+        read_size = self.READ_SIZE
+        max_size = max(self.MAX_READ_SIZE, read_size)
+        size = min(max(self._read_size or read_size, read_size), max_size)
         
-        split = []
-        prev = 0
-        for match in self._prompt.finditer(buf):
-            if match.groups()[0]:
-                t = datetime.time(int(match.groups()[0]), int(match.groups()[1]), tzinfo=TZINFO)
-            else:
-                t = None
-            split.append((buf[prev:match.start()], t))
-            prev = match.end()
+        data = self.ics.recv(size)
+        n = len(data)
+        # Grow while reads are filled, shrink when they get small again.
+        if n == size:
+            self._read_size = min(size * 2, max_size)
+        elif n < size // 4 and size > read_size:
+            self._read_size = max(size // 2, read_size)
+        return data
+    
+    
+    def _parse(self, string):
+        """Parse what was read."""
+        if self.recorder is not None:
+            self.recorder.record(string)
         
-        # The last item in list is not yet complete.
-        self._buffer = buf[prev:]
+        # The framer only scans the new data and keeps the last incomplete
+        # chunk itself.
+        split = self._framer.feed(string)
 
         # loop through all the outputs and match each with all regexes, after
         # checking for blocks.
@@ -514,41 +1051,101 @@ class IcsBot(object):
                     data = info['data'].strip()
                     id_ = int(info['id'])
                     self.block_code = int(info['code'])
-                    if self._block_funcs.has_key(id_):
-                        handler = self._block_funcs[id_]
-                        self.send(handler[0](data, *handler[1], **handler[2]))
-                        del self._block_funcs[id_]
-                        self._used_blocks.remove(id_)
+                    handled = self._block_funcs.has_key(id_)
+                    if handled:
+                        execute = self._release_block(id_)
+                        if self.metrics is None:
+                            self.send(execute.handler(data, *execute.args, **execute.kwargs))
+                        else:
+                            started = time.time()
+                            self.metrics.execute(execute.command, started - execute.sent)
+                            self.send(execute.handler(data, *execute.args, **execute.kwargs))
+                            self.metrics.handler(execute.handler, time.time() - started)
                 else:
                     data = block.strip()
                     self.block_code = None
-                                                
-                for (regex, function) in self._registered:
-                    match = regex.match(data)
-                    if match:
-                        self.send(function(match))
-                        break
+                    handled = False
                 
-                if self.unmatched_log is not None:
+                matched, result = self._registered.dispatch(data)
+                if matched:
+                    self.send(result)
+                elif not handled and data and self.unmatched_log is not None:
                     self.unmatched_log.write(block)
-            
+        
+        self._collect_offloaded()
+        self._flush()
+
+    def _run_timers(self):
+        """Execute all timers that are due (and send what offloaded functions
+        returned). Returns the time in seconds until the next timer, or None
+        if there is none. While offloaded functions are running, this is at
+        most self.OFFLOAD_POLL, and while commands wait for SEND_RATE it is at
+        most the time until the next one may be written.
+        """
+        # Current time, we don't want any chance of race conditions here.
+        t = time.time()
+        timer = self._timers.pop_due(t)
+        while timer is not None:
+            if self.metrics is None:
+                self.send(timer())
+            else:
+                self.metrics.timer(t - timer.due)
+                started = time.time()
+                self.send(timer())
+                self.metrics.handler(timer.function, time.time() - started)
+            timer = self._timers.pop_due(t)
+        self._collect_offloaded()
+        self._flush()
+        
+        next = self._timers.next_time()
+        if next is not None:
+            next = next - t
+        if self._offload is not None and self._offload.pending():
+            if next is None or next > self.OFFLOAD_POLL:
+                next = self.OFFLOAD_POLL
+        waiting = self._output.next_time(self.SEND_RATE)
+        if waiting is not None and (next is None or waiting < next):
+            next = waiting
+        return next
+
+
+    def _closed(self):
+        """Called when the server closed the connection, raises the
+        corresponding ConnectionClosed exception.
+        """
+        b = self._framer.pending()
+        
+        if '**** You have been kicked out by' in b:
+            raise(ConnectionClosed('Nuked'))
+        elif 'you can\'t both be logged in. ****' in b:
+            raise ConnectionClosed('Someone logged in as me.')
+        elif 'Logging you out.' in b:
+            raise ConnectionClosed('Closed by us.')
+        else:
+            raise ConnectionClosed()
+
+
+    def _timeout(self):
+        """Called when the connection was quiet for TIMEOUT seconds."""
+        self.send('$quit')
+        self._flush(force=True)
+        self.ics.close()
+        del self.ics
+        raise ConnectionClosed('Socket timeout')
+
 
     def run(self):
         # The mainloop
+        import socket
         timed = False
         while True:
-            # Current time, we don't want any chance of race conditions here.
             # The timeout, must not be 0/negative, or we get a non-blocking
             # reading and a different exception. Don't feel like thinking about
             # it more.
-            t = time.time()
-            while self._timed and self._timed[0][0] <= t:
-                self.send(self._timed[0][1](*self._timed[0][2], **self._timed[0][3]))
-                del self._timed[0]
-            
-            if self._timed:
-                next = self._timed[0][0] - t
+            next = self._run_timers()
+            if next is not None:
                 timed = True
+                next = max(next, 0.001)
             else:
                 # We use default timeout:
                 next = self.TIMEOUT
@@ -556,33 +1153,47 @@ class IcsBot(object):
             
             self.ics.settimeout(next)    
             try:
-                data = self.ics.recv(self.READ_SIZE)
+                data = self._read()
             # If a timeout is hit, we don't need to parse something.
             except socket.timeout:
                 if not timed:
-                    self.send('$quit')
-                    self.ics.close()
-                    del self.ics
-                    raise ConnectionClosed('Socket timeout')
+                    self._timeout()
                 continue
 
-            if data == '':
+            if not data:
                 # Raise a corresponding exception or close if all is good.
-                b = self._buffer
-                
-                if '**** You have been kicked out by' in b:
-                    raise(ConnectionClosed('Nuked'))
-                elif 'you can\'t both be logged in. ****' in b:
-                    raise ConnectionClosed('Someone logged in as me.')
-                elif 'Logging you out.' in b:
-                    raise ConnectionClosed('Closed by us.')
-                else:
-                    raise ConnectionClosed()
+                self._closed()
             
             # Parse and act upon the data if functions are registered:
             self._parse(data)
 
 
+    def run_async(self, map=None):
+        """Same as run, but using asyncore, so that the bot can live in the
+        same process as other asyncore dispatchers. Give the asyncore map if
+        you do not use the default one. The bot must be connected first
+        (connecting is still blocking). Like run, this only returns by raising
+        ConnectionClosed (or any error raised by a function).
+        
+        NOTE: Other dispatchers in the map will be served while the bot waits,
+            handlers and timers of the bot itself still run inline.
+        """
+        import _async
+        dispatcher = _async.IcsDispatcher(self, map)
+        try:
+            while True:
+                next = self._run_timers()
+                if next is None and self.TIMEOUT:
+                    # Same as run, we only time out if no timer is waiting.
+                    next = self.TIMEOUT - (time.time() - dispatcher.last_read)
+                    if next <= 0:
+                        self._timeout()
+                
+                dispatcher.loop(next)
+        finally:
+            dispatcher.del_channel()
+
+
 
 class InvalidLogin(Exception):
     """Is raised if the Login fails (not because of a connection error).
@@ -0,0 +1,50 @@
+"""
+asyncore support for IcsBot, see IcsBot.run_async.
+"""
+
+import asyncore, time
+
+
+class IcsDispatcher(asyncore.dispatcher):
+    """Dispatcher reading from the socket of a connected IcsBot and feeding
+    the data to its parser.
+    """
+
+    def __init__(self, icsbot, map=None):
+        asyncore.dispatcher.__init__(self, icsbot.ics, map)
+        self._icsbot = icsbot
+        # asyncore makes the socket non blocking. We only read when select
+        # says there is something, but the bot writes to the socket directly
+        # so it needs to block for writing.
+        icsbot.ics.settimeout(None)
+        self.last_read = time.time()
+
+
+    def loop(self, timeout):
+        """Wait at most timeout seconds (None is forever) for anything to
+        happen in the map and handle it.
+        """
+        # asyncore stores the map (or its default one) in self._map.
+        asyncore.loop(timeout, map=self._map, count=1)
+
+
+    def writable(self):
+        return False
+
+
+    def handle_read(self):
+        data = self._icsbot._read()
+        self.last_read = time.time()
+        if not data:
+            self._icsbot._closed()
+        self._icsbot._parse(data)
+
+
+    def handle_close(self):
+        self._icsbot._closed()
+
+
+    def handle_error(self):
+        # Do not let asyncore swallow ConnectionClosed or errors of the
+        # handlers, we are still inside the except clause here.
+        raise
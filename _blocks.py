@@ -0,0 +1,118 @@
+"""
+Bookkeeping for commands executed with FICS block mode (IcsBot.execute).
+"""
+
+import time
+from collections import deque
+
+
+class BlockIds(object):
+    """Allocator for the block ids send with executed commands. Freed ids
+    go to the end of the free list, so that an id is reused as late as
+    possible (a reply that comes in after its execute timed out is then most
+    likely ignored instead of given to the wrong handler).
+        o allocate() -> (id, generation) or raises IndexError if all are used.
+        o release(id)
+        o len(BlockIds) is the number of free ids.
+    The generation is increased every time an id is allocated, so that
+    something holding on to an (id, generation) pair can check if the id
+    was reused in the meantime.
+    """
+
+    def __init__(self, first=2, last=999):
+        # Block id 1 is used for all commands that are only send.
+        self._free = deque(xrange(first, last + 1))
+        self._generation = {}
+
+
+    def allocate(self):
+        id_ = self._free.popleft()
+        generation = self._generation.get(id_, 0) + 1
+        self._generation[id_] = generation
+        return id_, generation
+
+
+    def release(self, id_):
+        self._free.append(id_)
+
+
+    def generation(self, id_):
+        return self._generation.get(id_, 0)
+
+
+    def __len__(self):
+        return len(self._free)
+
+
+class Execute(object):
+    """A command executed (or waiting to be executed) through block mode.
+    queued is the time it was executed, the id and generation are set when
+    it gets a block id, the sent time and timer when it is written.
+    priority is the output queue it is written with (see IcsBot.SEND_RATE).
+    """
+
+    def __init__(self, command, handler, args=(), kwargs={}, timeout=None, on_error=None):
+        self.command = command
+        self.handler = handler
+        self.args = args
+        self.kwargs = kwargs
+        self.timeout = timeout
+        self.on_error = on_error
+        self.priority = 'execute'
+
+        self.queued = time.time()
+        self.id = None
+        self.generation = None
+        self.sent = None
+        self.timer = None
+
+
+class Result(object):
+    """The (future) reply of a command run with IcsBot.request. Several
+    requests for the same command share one Result.
+        o add_callback(function, *args, **kwargs): function(data, *args,
+           **kwargs) is called when the reply is there (or right away if it
+           already is). What it returns is send, like for execute handlers.
+           If the execute timed out, data is None.
+        o done(): True if the reply is there (or the execute timed out).
+        o data: The reply data (or None).
+        o block_code: The FICS block code of the reply (or None).
+        o failed: True if the execute timed out.
+        o time: time.time() of when the reply came in.
+    """
+
+    def __init__(self, icsbot, command):
+        self._icsbot = icsbot
+        self.command = command
+        self._callbacks = []
+        self._done = False
+        self.data = None
+        self.block_code = None
+        self.failed = False
+        self.time = None
+        # The Execute getting the reply, see IcsBot._disconnected.
+        self._execute = None
+
+
+    def done(self):
+        return self._done
+
+
+    def add_callback(self, function, *args, **kwargs):
+        if self._done:
+            self._icsbot.send(function(self.data, *args, **kwargs))
+            return
+        self._callbacks.append((function, args, kwargs))
+
+
+    def _resolve(self, data, block_code, t, failed=False):
+        self.data = data
+        self.block_code = block_code
+        self.failed = failed
+        self.time = t
+        self._done = True
+
+        callbacks = self._callbacks
+        self._callbacks = []
+        for function, args, kwargs in callbacks:
+            self._icsbot.send(function(data, *args, **kwargs))
@@ -0,0 +1,116 @@
+"""
+LRU cache keeping the most recently used Data items alive, see Data.
+"""
+
+import time
+
+# Fields of a link in the (circular, doubly linked) list.
+_PREV, _NEXT, _KEY, _VALUE, _EXPIRES = 0, 1, 2, 3, 4
+
+
+class LRUCache(object):
+    """Strong references to the capacity most recently used values. Used
+    values are moved to the front with touch (O(1)), the least recently used
+    one is dropped when there are too many. With ttl, values are also
+    dropped ttl seconds after they were last touched.
+        o touch(key, value)
+        o discard(key)
+        o resize(capacity, ttl=None)
+        o evictions, expired: Number of values dropped for each reason.
+    """
+
+    def __init__(self, capacity, ttl=None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.evictions = 0
+        self.expired = 0
+        self._links = {}
+        # The root link, root[_NEXT] is the least recently used value.
+        self._root = root = []
+        root[:] = [root, root, None, None, None]
+
+
+    def __len__(self):
+        return len(self._links)
+
+
+    def __contains__(self, key):
+        return key in self._links
+
+
+    def touch(self, key, value):
+        """Add value (or mark it as used if it already is cached)."""
+        root = self._root
+        if self.ttl is None:
+            expires = None
+        else:
+            expires = time.time() + self.ttl
+            self._expire(expires - self.ttl)
+
+        link = self._links.get(key)
+        if link is not None:
+            if link[_NEXT] is root:
+                # Already the most recently used one.
+                link[_VALUE] = value
+                link[_EXPIRES] = expires
+                return
+            link[_PREV][_NEXT] = link[_NEXT]
+            link[_NEXT][_PREV] = link[_PREV]
+            link[_VALUE] = value
+            link[_EXPIRES] = expires
+        else:
+            link = [None, None, key, value, expires]
+            self._links[key] = link
+
+        last = root[_PREV]
+        last[_NEXT] = root[_PREV] = link
+        link[_PREV] = last
+        link[_NEXT] = root
+
+        while len(self._links) > self.capacity:
+            self._drop(root[_NEXT])
+            self.evictions += 1
+
+
+    def discard(self, key):
+        """Drop the value for key if it is cached."""
+        link = self._links.get(key)
+        if link is not None:
+            self._drop(link)
+
+
+    def resize(self, capacity, ttl=None):
+        """Change capacity and ttl. If ttl changes, the ttl of all cached
+        values starts now.
+        """
+        self.capacity = capacity
+        root = self._root
+        while len(self._links) > capacity:
+            self._drop(root[_NEXT])
+            self.evictions += 1
+        if ttl != self.ttl:
+            if ttl is None:
+                expires = None
+            else:
+                expires = time.time() + ttl
+            for link in self._links.itervalues():
+                link[_EXPIRES] = expires
+        self.ttl = ttl
+
+
+    def _expire(self, t):
+        # The least recently used values expire first.
+        root = self._root
+        oldest = root[_NEXT]
+        while oldest is not root and oldest[_EXPIRES] is not None and oldest[_EXPIRES] <= t:
+            self._drop(oldest)
+            self.expired += 1
+            oldest = root[_NEXT]
+
+
+    def _drop(self, link):
+        link[_PREV][_NEXT] = link[_NEXT]
+        link[_NEXT][_PREV] = link[_PREV]
+        del self._links[link[_KEY]]
+        # Make sure the value is not kept alive by the link.
+        link[_VALUE] = None
@@ -1,23 +1,52 @@
-import gc
+from _cache import LRUCache
+from _index import HashIndex, SortedIndex
+import _persist
+
+
+# The registered functions are stored in dictionaries
+# item -> [[persistent function, ...], [one time function, ...]].
+
+def _add_function(table, item, function, persistent):
+    entry = table.get(item)
+    if entry is None:
+        entry = table[item] = [[], []]
+    if persistent:
+        entry[0].append(function)
+    else:
+        entry[1].append(function)
+
+
+def _remove_function(table, item, function):
+    entry = table[item]
+    if function in entry[0]:
+        entry[0].remove(function)
+    else:
+        entry[1].remove(function)
+    if not entry[0] and not entry[1]:
+        del table[item]
+
+
+def _call_functions(table, obj, item, old, new):
+    entry = table.get(item)
+    if entry is None:
+        return
+    once = entry[1]
+    if once:
+        # Drop them before calling, they may register themselves again.
+        entry[1] = []
+        if not entry[0]:
+            del table[item]
+    for function in entry[0]:
+        function(obj, item, old, new)
+    for function in once:
+        function(obj, item, old, new)
 
-def _freeze_gc(func):
-    """Decorator function to freeze the garbage collector if it was enabled.
-    THIS SHOULD BE NOT NEEDED, AND INDEED I CANNOT REPRODUCE BUG RIGHT NOW.
-    MAYBE CHECKED NOT ENOUGH THEN, OR BUGGY PYTHON.
-    """
-    def new_func(*args, **kwargs):
-        status = gc.isenabled()
-        gc.disable()
-        output = func(*args, **kwargs)
-        if status is True:
-            gc.enable()
-        return output
-    return new_func
 
 class _Item(object):
     """
     ITEM (USER) OBJECT. Do not create directly, only use it through the
      Data class!
+        o update(dictionary, notify=True) sets many items at once.
         o item is a dictionary with currently set values. You can use this to:
             1. Circumvent all other checks ;) (other functions watching/setting)
             2. To edit a fields entry instead of setting it to a copy of itself
@@ -34,11 +63,19 @@ class _Item(object):
            won't drop it.
            
     NOTE:
-        Items are weakrefed, however during __getitem__, __setitem__ and __delitem__
-        operations which can trigger other things, the garbage collector is disbabled.
-        This should make it save if a dataitem is temporarily unrefed.
+        Items are weakrefed, however while loaders or registered functions
+        run (which can trigger other things), the Data holds a strong
+        reference to the item (it is pinned). This makes it save if a dataitem
+        is temporarily unrefed.
+        
+        The Items of a compact Data (see Data) have no __dict__, so arbitrary
+        attributes cannot be set on them, only items.
     """    
     
+    # _updates is the instance level dictionary of registered functions (see
+    # register), it is None until something is registered.
+    __slots__ = ('items', '_updates', '__weakref__')
+    
     main_key = 'handle'
 
     ### Init and other functions:    
@@ -49,11 +86,24 @@ class _Item(object):
         
         self.items = {}
         self.items[self.main_key] = handle
-     
-        # Dictionary item -> [function, ...] to execute functions when the item
-        # is updated. Use register(item, function) to use this.
-        self._on_update = {}
-        self.loader = {}
+        self._updates = None
+
+
+    def _pin(self):
+        # Let the Data hold a strong reference while loaders or registered
+        # functions run. Nested calls are counted.
+        entry = self.__class__._pinned.get(id(self))
+        if entry is None:
+            self.__class__._pinned[id(self)] = [self, 1]
+        else:
+            entry[1] += 1
+
+
+    def _unpin(self):
+        entry = self.__class__._pinned[id(self)]
+        entry[1] -= 1
+        if not entry[1]:
+            del self.__class__._pinned[id(self)]
 
 
     def __str__(self):
@@ -65,10 +115,7 @@ class _Item(object):
         If this function does not exist, the item is deleted. The function
         does return the new value or None.
         """
-        try:
-            self.__class__._loader[item](self, item)
-        except KeyError:
-            pass
+        self.reset(item)
                     
 
     def register(self, item, function, persistent=False):
@@ -82,20 +129,16 @@ class _Item(object):
                add it to the _item_set()/_item_load() special function.
         """
 
-        if self._on_update.has_key(item):
-            self._on_update[item] += [[function, persistent]]
-            return
-        self._on_update[item] = [[function, persistent]]
+        if self._updates is None:
+            self._updates = {}
+        _add_function(self._updates, item, function, persistent)
         
 
     def unregister(self, item, function):
         """
         Unregister a function again ...
         """
-        try:
-            self._on_update[item].remove([function, True])
-        except ValueError:
-            self._on_update[item].remove([function, False])
+        _remove_function(self._updates, item, function)
 
 
     # Item setting base functions:
@@ -109,20 +152,17 @@ class _Item(object):
         """
         return self.__getitem__(item, default)
 
-    @_freeze_gc
     def __getitem__(self, item, default=None):
         """Returns the item. (After loading it if necessary.)
         Be careful about editing the item. As this editing might be in place,
         nothing will be triggered in that case.
         """
-        if self.items.has_key(item):
-            return self.items[item]
-
         try:
-            self.__class__._loader[item](self, item)
+            return self.items[item]
         except KeyError:
             pass
-        
+
+        self.reset(item)
         return self.items.get(item, default)
     
     
@@ -130,7 +170,7 @@ class _Item(object):
         """Return True if the item either is already set, or there is a loader
         for it.
         """
-        return self.items.has_key(item) or item in self.loader or item in self.__class__._loader
+        return self.items.has_key(item) or item in self.__class__._loader
     
     
     def copy(self):
@@ -144,12 +184,16 @@ class _Item(object):
         delete the item.
         """
         try:
-            self.__class__._loader[item](self, item)
+            loader = self.__class__._loader[item]
         except KeyError:
-            pass
+            return
+        self._pin()
+        try:
+            loader(self, item)
+        finally:
+            self._unpin()
     
     
-    @_freeze_gc
     def __setitem__(self, item, new):
         """
         Set the value of the specific item, or execute the special function
@@ -165,35 +209,61 @@ class _Item(object):
         if old == new:
             return
 
-        if self.__class__._on_update.has_key(item):
-            to_del = []
-            for function, pers in self.__class__._on_update[item]:
-                if not pers:
-                    to_del += [function]
-                function(self, item, old, new)
-        
+        if item in self.__class__._on_update or \
+                (self._updates is not None and item in self._updates):
+            self._changed(item, old, new)
 
-            for function in to_del:
-                self.__class__._on_update[item].remove([function, False])
-        
-            if not self.__class__._on_update[item]:
-                del self.__class__._on_update[item]
-        
-        if self._on_update.has_key(item):
-            to_del = []    
-            for function, pers in self._on_update.get(item, []):
-                if not pers:
-                    to_del += [function]
-                function(self, item, old, new)    
-
-            for function in to_del:
-                self._on_update[item].remove([function, False])
+
+    def update(self, mapping, notify=True):
+        """
+        update(dictionary, notify=True)
+        Set all items of the dictionary. The registered functions are called
+        (for the items that changed) after all of them are set. With
+        notify=False nothing is called, like updating item.items directly.
+        """
+        items = self.items
+        if not notify:
+            items.update(mapping)
+            return
         
-            if not self._on_update[item]:
-                del self._on_update[item]        
+        # Only the items that something is registered for need the diff.
+        on_update = self.__class__._on_update
+        updates = self._updates
+        watched = [(name, items.get(name), new) for name, new in mapping.iteritems()
+                   if name in on_update or (updates is not None and name in updates)]
+        items.update(mapping)
+        for name, old, new in watched:
+            if old != new:
+                self._changed(name, old, new)
+
+
+    def _changed(self, item, old, new):
+        batch = self.__class__._batch
+        if batch is not None:
+            # Only remember the first old and the last new value (see
+            # Data.begin), the item is kept alive by the batch.
+            changes, order = batch
+            change = changes.get((id(self), item))
+            if change is None:
+                change = changes[id(self), item] = [self, item, old, new]
+                order.append(change)
+            else:
+                change[3] = new
+            return
+
+        self._pin()
+        try:
+            self._dispatch(item, old, new)
+        finally:
+            self._unpin()
+
+
+    def _dispatch(self, item, old, new):
+        _call_functions(self.__class__._on_update, self, item, old, new)
+        if self._updates is not None:
+            _call_functions(self._updates, self, item, old, new)
     
     
-    @_freeze_gc
     def __delitem__(self, item):
         """Delete the specific item or execute the special function for it and then
         delete it. (Do nothing if item doesn't exist).
@@ -201,13 +271,28 @@ class _Item(object):
         if not self.items.has_key(item):
             return
 
-        del self.items[item]
+        old = self.items.pop(item)
+        if item in self.__class__._on_update or \
+                (self._updates is not None and item in self._updates):
+            self._changed(item, old, None)
 
-        for function in self.__class__._on_update.get(item, []):
-            function(self, old, None)
-        
-        for function in self._on_update.get(item, []):
-            function(self, old, None)
+
+class _CompactItem(_Item):
+    """
+    Item of a compact Data. It has no __dict__ and the names of the items
+    are shared between all items of the Data (see Data).
+    """
+    
+    __slots__ = ()
+    
+    def __setitem__(self, item, new):
+        # Use the one name object of the Data for the key.
+        _Item.__setitem__(self, self.__class__._fields.setdefault(item, item), new)
+    
+    def update(self, mapping, notify=True):
+        fields = self.__class__._fields
+        mapping = dict([(fields.setdefault(name, name), value) for name, value in mapping.iteritems()])
+        _Item.update(self, mapping, notify)
 
 
 
@@ -234,8 +319,9 @@ class Data(object):
            The registered function can change the items value by directly
            editing the User.items dictionary.
         o Registered functions are executed in the order that they are
-           gotten. Classes ones are executed before Instance ones, so that
-           they could modify the value before the instance thinks it changed.
+           gotten, persistent ones before one time ones. Classes ones are
+           executed before Instance ones, so that they could modify the value
+           before the instance thinks it changed.
            Instance ones _will_ also be executed if old == new.
     
     TIPS:
@@ -251,20 +337,82 @@ class Data(object):
            that you will need the dummy "finger_update" to force a reload
            through the finger function. (Of course this is rather
            hypethetical, afterall finger is always more up to date ;))
-           
-    Maybe the buffer should be improved ...
+    
+    BUFFER:
+        o The buffer_size most recently used items are kept alive even if
+           nothing else references them (LRU, getting an item marks it as
+           used). With ttl they are only kept that many seconds after they
+           were last used. Use set_buffer to change it and cache_stats
+           to see how well it works.
+    
+    BATCHES:
+        o Between begin() and commit() the registered functions are not
+           called. The changes are collected and at commit the functions
+           are called once for each changed (item, name) with the value
+           before the batch and the last one (nothing if it is the same
+           again). Use this when setting many items at once (ie. the who
+           list in status):
+               users.begin()
+               try:
+                   ...
+               finally:
+                   users.commit()
+    
+    INDEXES:
+        o add_index(name, sorted=False, key=None) keeps an index of the
+           (living) items by the value of name, so that find(name, value)
+           does not need to look at all items. With sorted (ie. for
+           ratings, with key=int) find_range(name, low, high) and
+           top(name, n) can be used too. The index is kept up to date by a
+           registered function, so it does not see changes to item.items
+           (or inside a batch before the commit).
+    
+    PERSISTENCE:
+        o snapshot(path) writes all living items to a file, journal(path,
+           names) appends every change of the given items (names) to a
+           journal file and restore(path, journal_path) gets the state back
+           after a restart (create the Status after restoring, the who list
+           then only changes the users that came or left meanwhile). Only
+           values marshal can store are kept. This is for data sets with
+           stable keys (users), the server reuses game numbers.
+    
+    COMPACT:
+        o With compact=True the items use __slots__ (no __dict__, so no
+           arbitrary attributes on them) and the item names are shared
+           between all items. This is worth it for large data sets like all
+           users of FICS. item['x'] and item.items work the same.
     """
 
-    def __init__(self, main_key='handle', buffer_size = 20):
+    def __init__(self, main_key='handle', buffer_size = 20, ttl=None, compact=False):
         # Define a dummy class and self.Item to make sure that each Users class
         # has its own child User class.
-        class Items(_Item):
-            _on_update = {}
-            _loader = {}
+        if compact:
+            class Items(_CompactItem):
+                __slots__ = ()
+                _on_update = {}
+                _loader = {}
+                _pinned = {}
+                _batch = None
+                _batch_loader = {}
+                # name -> name, so that all items use the same key objects.
+                _fields = {}
+        else:
+            class Items(_Item):
+                _on_update = {}
+                _loader = {}
+                _pinned = {}
+                _batch = None
+                _batch_loader = {}
 
         self.main_key = main_key
+        self.compact = compact
         Items.main_key = main_key
+        # id(item) -> [item, depth] of the items with loaders or registered
+        # functions running, see _Item._pin.
+        self._pinned = Items._pinned
         self.Item = Items
+        # Nesting depth of begin() calls, see Items._batch.
+        self._batch_depth = 0
 
         # Buffer to make sure we don't discard items that often ...
         # As long as the item has a reference stored here or ANYWHERE else
@@ -272,16 +420,28 @@ class Data(object):
         if buffer_size < 1:
             self._buffer = None
         else:
-            self._buffer = [None]*buffer_size
+            self._buffer = LRUCache(buffer_size, ttl)
+        self._hits = 0
+        self._misses = 0
+        # Calls of batch loaders by prefetch and the items they loaded.
+        self._batch_loads = 0
+        self._batch_loaded = 0
+        
+        # name -> HashIndex or SortedIndex, see add_index.
+        self._indexes = {}
+        # None or (_persist.Journal, registered function, names), see journal.
+        self._journal = None
+        # True while commit calls the registered functions.
+        self._committing = False
 
         # dictionary mapping item_name -> item object. This is a WEAKREF!
         from weakref import WeakValueDictionary
         self._loaded_items = WeakValueDictionary()
     
 
-    def register(self, item, function, persistent=True, loader=False):
+    def register(self, item, function, persistent=True, loader=False, batch=False):
         """
-        register(item, function, persistent=True)
+        register(item, function, persistent=True, loader=False, batch=False)
         Register a function to be executed when item gets updated next time.
         Multiple functions can be registered, all will update when this happens.
         NOTES:
@@ -292,16 +452,24 @@ class Data(object):
                get event. (First time load). Only one function can be
                assigned. quietly overwrites all existing ones.
                Always persistent. The function MUST set the item.
+            o batch keyword (with loader): The function takes a list of
+               item objects and the item name, and MUST set the item on all
+               of them. prefetch calls it once for many items, getting a
+               single item calls it with a list of one.
         This will register for ALL items.
         """
         if loader == True:
-            self.Item._loader[item] = function
-            return
-            
-        if self.Item._on_update.has_key(item):
-            self.Item._on_update[item].append([function, persistent])
+            if batch:
+                def load(item_object, item):
+                    function([item_object], item)
+                self.Item._batch_loader[item] = function
+                self.Item._loader[item] = load
+            else:
+                self.Item._batch_loader.pop(item, None)
+                self.Item._loader[item] = function
             return
-        self.Item._on_update[item] = [[function, persistent]]
+        
+        _add_function(self.Item._on_update, item, function, persistent)
 
     
     def unregister(self, item, function, loader):
@@ -310,11 +478,244 @@ class Data(object):
         """
         if loader:
             del self.Item._loader[item]
+            self.Item._batch_loader.pop(item, None)
+            return
+        _remove_function(self.Item._on_update, item, function)
+
+
+    def prefetch(self, keys, fields=None):
+        """
+        prefetch(keys, fields=None) -> list of the items for keys.
+        Get the items and load the given items (names) for all of them that
+        do not have them set yet, with one call of each batch loader (see
+        register). With fields=None all items with a batch loader are
+        loaded. Items without a batch loader are loaded one by one.
+        """
+        items = [self[key] for key in keys]
+        if fields is None:
+            fields = self.Item._batch_loader.keys()
+        
+        for field in fields:
+            missing = []
+            seen = set()
+            for item in items:
+                if field not in item.items and id(item) not in seen:
+                    seen.add(id(item))
+                    missing.append(item)
+            if not missing:
+                # ie. a batch loader for all columns already loaded this one.
+                continue
+            
+            function = self.Item._batch_loader.get(field)
+            if function is None:
+                for item in missing:
+                    item.reset(field)
+                continue
+            # The items are kept alive by the list while it runs.
+            function(missing, field)
+            self._batch_loads += 1
+            self._batch_loaded += len(missing)
+        return items
+
+
+    def snapshot(self, path):
+        """
+        snapshot(path)
+        Write all living items to path. If a journal is open it is started
+        over, as the snapshot includes its changes.
+        """
+        _persist.write_snapshot(path, self.main_key, [item.items for item in self.itervalues()])
+        if self._journal is not None:
+            self._journal[0].truncate()
+    
+    
+    def journal(self, path, fields):
+        """
+        journal(path, names)
+        Append all changes of the given items (names) of all items to the
+        journal at path (see restore). The file is flushed after every
+        change, or once at the commit of a batch (see begin).
+        """
+        if self._journal is not None:
+            self.close_journal()
+        journal = _persist.Journal(path)
+        main_key = self.main_key
+        def changed(item, name, old, new):
+            if name in item.items:
+                journal.record(item.items[main_key], name, new)
+            else:
+                journal.delete(item.items[main_key], name)
+            if not self._committing:
+                journal.flush()
+        for field in fields:
+            self.register(field, changed)
+        self._journal = (journal, changed, list(fields))
+    
+    
+    def close_journal(self):
+        journal, changed, fields = self._journal
+        self._journal = None
+        for field in fields:
+            self.unregister(field, changed, False)
+        journal.close()
+    
+    
+    def restore(self, path, journal_path=None):
+        """
+        restore(path, journal_path=None) -> list of the restored items.
+        Set the items from a snapshot and the changes from a journal written
+        after it. No registered functions are called (like setting
+        item.items directly), but the indexes are updated. Keep a reference
+        to the items you need, the others are dropped like any other item.
+        """
+        if self.compact:
+            fields = self.Item._fields
+        else:
+            fields = None
+        
+        main_key, entries = _persist.read_snapshot(path)
+        restored = {}
+        for values in entries:
+            item = self[values[main_key]]
+            if fields is not None:
+                values = dict([(fields.setdefault(name, name), value) for name, value in values.iteritems()])
+            item.items.update(values)
+            restored[id(item)] = item
+        
+        if journal_path is not None:
+            for record in _persist.read_journal(journal_path):
+                item = self[record[0]]
+                name = record[1]
+                if fields is not None:
+                    name = fields.setdefault(name, name)
+                if len(record) == 2:
+                    item.items.pop(name, None)
+                else:
+                    item.items[name] = record[2]
+                restored[id(item)] = item
+        
+        restored = restored.values()
+        for index in self._indexes.itervalues():
+            for item in restored:
+                index.discard(item)
+                index.add(item, item.items.get(index.field))
+        return restored
+    
+    
+    def add_index(self, field, sorted=False, key=None):
+        """
+        add_index(name, sorted=False, key=None)
+        Index the items by the value of name. key is a function the values
+        are converted with first (values it fails for are not indexed).
+        Replaces an existing index for name.
+        """
+        if field in self._indexes:
+            self.remove_index(field)
+        if sorted:
+            index = SortedIndex(field, key)
+        else:
+            index = HashIndex(field, key)
+        for item in self.itervalues():
+            index.add(item, item.items.get(field))
+        self._indexes[field] = index
+        self.register(field, index._changed)
+    
+    
+    def remove_index(self, field):
+        index = self._indexes.pop(field)
+        self.unregister(field, index._changed, False)
+    
+    
+    def find(self, field, value):
+        """
+        find(name, value) -> list of the items with item[name] == value.
+        Without an index for name all items are checked.
+        """
+        if field in self._indexes:
+            return self._indexes[field].find(value)
+        return [item for item in self.itervalues() if item.items.get(field) == value]
+    
+    
+    def _sorted_index(self, field):
+        index = self._indexes.get(field)
+        if not isinstance(index, SortedIndex):
+            raise ValueError('No sorted index for %r, see add_index.' % (field,))
+        return index
+    
+    
+    def find_range(self, field, low=None, high=None):
+        """
+        find_range(name, low=None, high=None) -> list of the items with
+        low <= item[name] <= high (None for no limit), sorted by it. Needs a
+        sorted index for name.
+        """
+        return self._sorted_index(field).find_range(low, high)
+    
+    
+    def top(self, field, n, reverse=True):
+        """
+        top(name, n, reverse=True) -> list of the n items with the highest
+        (or with reverse=False lowest) item[name]. Needs a sorted index for
+        name.
+        """
+        return self._sorted_index(field).top(n, reverse)
+
+
+    def bulk_update(self, mappings, notify=True):
+        """
+        bulk_update({key: dictionary, ...}, notify=True)
+        Update many items at once (see _Item.update). With notify the
+        registered functions are called in one batch (see begin) after all
+        items are updated.
+        """
+        if not notify:
+            for key, mapping in mappings.iteritems():
+                self[key].update(mapping, False)
             return
+        
+        self.begin()
         try:
-            self.Item._on_update[item].remove([function, True])
-        except ValueError:
-            self.Item._on_update[item].remove([function, False])
+            for key, mapping in mappings.iteritems():
+                self[key].update(mapping)
+        finally:
+            self.commit()
+
+
+    def begin(self):
+        """
+        Start a batch, the registered functions are only called at commit.
+        Batches can be nested, only the outer commit calls them.
+        """
+        if not self._batch_depth:
+            # ({(id(item), name): change}, [change, ...]) where change is
+            # [item, name, old, new].
+            self.Item._batch = ({}, [])
+        self._batch_depth += 1
+
+
+    def commit(self):
+        """
+        End a batch and call the registered functions for the changes.
+        """
+        self._batch_depth -= 1
+        if self._batch_depth:
+            return
+        changes, order = self.Item._batch
+        self.Item._batch = None
+        self._committing = True
+        try:
+            for item, name, old, new in order:
+                if old == new:
+                    continue
+                item._pin()
+                try:
+                    item._dispatch(name, old, new)
+                finally:
+                    item._unpin()
+        finally:
+            self._committing = False
+            if self._journal is not None:
+                self._journal[0].flush()
 
 
     def __getitem__(self, handle):
@@ -322,10 +723,14 @@ class Data(object):
             ident = handle.lower()
         except AttributeError:
             ident = handle
-        if not self._loaded_items.has_key(ident):
+        item = self._loaded_items.get(ident)
+        if item is None:
+            self._misses += 1
             return self._load(handle)
-        #print handle, ident, self._loaded_items[ident].items
-        return self._loaded_items[ident]
+        self._hits += 1
+        if self._buffer is not None:
+            self._buffer.touch(ident, item)
+        return item
 
 
     def _load(self, handle):
@@ -337,11 +742,46 @@ class Data(object):
         
         self._loaded_items[ident] = new_item
         if self._buffer is not None:
-            del self._buffer[0]
-            self._buffer += [new_item]
+            self._buffer.touch(ident, new_item)
         return new_item        
 
 
+    def set_buffer(self, buffer_size, ttl=None):
+        """
+        set_buffer(buffer_size, ttl=None)
+        Change how many recently used items are kept alive (and for how many
+        seconds with ttl). A buffer_size < 1 disables the buffer.
+        """
+        if buffer_size < 1:
+            self._buffer = None
+        elif self._buffer is None:
+            self._buffer = LRUCache(buffer_size, ttl)
+        else:
+            self._buffer.resize(buffer_size, ttl)
+
+
+    def cache_stats(self):
+        """
+        Return a dictionary with:
+            o hits/misses: Lookups that found a living item or had to create
+               a new one (running the loaders again when used).
+            o evictions/expired: Items dropped from the buffer because it was
+               full or because of the ttl.
+            o buffered: Items in the buffer, loaded: items alive.
+            o batch_loads/batch_loaded: Calls of batch loaders by prefetch
+               and the number of items they loaded.
+        """
+        stats = {'hits': self._hits, 'misses': self._misses,
+                 'batch_loads': self._batch_loads, 'batch_loaded': self._batch_loaded,
+                 'evictions': 0, 'expired': 0, 'buffered': 0,
+                 'loaded': len(self._loaded_items)}
+        if self._buffer is not None:
+            stats['evictions'] = self._buffer.evictions
+            stats['expired'] = self._buffer.expired
+            stats['buffered'] = len(self._buffer)
+        return stats
+
+
     def iteritems(self):
         """Iterator over all stored items.
         """
@@ -0,0 +1,249 @@
+"""
+Indexed dispatch for the regexes registered with IcsBot.reg_comm.
+
+Instead of trying every registered regex on every block, registrations are
+bucketed by the leading token of the block they can match (the text before
+the first space, ie. "<wa>", "<wd>" or "{Game"). A block is then only tried
+against the registrations of its own bucket plus those that could not be
+indexed (ie. the tell regex, which starts with the handle). Registration
+order still decides which function gets the block.
+
+The leading token is either given on registration (prefix=...) or worked out
+from the pattern. It can only be worked out if the pattern starts with
+plain text that is followed by a space, ie. '^<wa> ...' or '^\\{Game ...'.
+Everything else is put into the "unindexed" list which is tried for all
+blocks.
+"""
+
+import re, time
+
+# Characters that end the literal start of a pattern.
+_SPECIAL = '.^$*+?{}[]|()\\'
+# Escaped characters that are literals.
+_ESCAPED_LITERAL = '.^$*+?{}[]|()\\<>-/:%#=@!,"\' '
+# These make the char before them optional/repeatable.
+_QUANTIFIERS = '*?{'
+
+
+def literal_token(regex):
+    """Return the leading token every match of the compiled regex (or pattern
+    string) must start with, or None if it cannot be worked out.
+    Only patterns without flags changing the meaning of the literal (ignore
+    case, verbose) and without an alternation are looked at.
+    """
+    if type(regex) is str or type(regex) is unicode:
+        pattern = regex
+        flags = 0
+    else:
+        pattern = regex.pattern
+        flags = regex.flags
+    if flags & (re.IGNORECASE | re.VERBOSE):
+        return None
+
+    # An unescaped | anywhere makes it hard to be sure, so give up.
+    i = 0
+    while i < len(pattern):
+        if pattern[i] == '\\':
+            i += 2
+            continue
+        if pattern[i] == '|':
+            return None
+        i += 1
+
+    i = 0
+    if pattern.startswith('^'):
+        i = 1
+    token = []
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            if i + 1 < len(pattern) and pattern[i+1] in _ESCAPED_LITERAL:
+                c = pattern[i+1]
+                i += 2
+            else:
+                return None
+        elif c in _SPECIAL:
+            return None
+        else:
+            i += 1
+
+        # The char must not be optional, but a + is fine.
+        if i < len(pattern) and pattern[i] in _QUANTIFIERS:
+            return None
+
+        if c == ' ':
+            if not token:
+                return None
+            return ''.join(token)
+        token.append(c)
+
+    return None
+
+
+class Dispatcher(object):
+    """Holds the regexes registered through IcsBot.reg_comm.
+        o register(regex, function, prefix=None)
+        o unregister(function)
+        o dispatch(data) -> (matched, return value of the function)
+        o stats() -> {token: [hits, misses]}, the token of blocks that did not
+           hit a bucket is None.
+    If profile is set to a dictionary, the time spend in the functions is
+    added up in it as pattern -> [calls, seconds].
+    Use set_metrics(_metrics.Metrics()) to collect the time of every regex
+    match and function call, and set_metrics(None) to stop again.
+    """
+
+    def __init__(self):
+        # Every registration is [seq, regex, function, token]
+        self._seq = 0
+        self._buckets = {}
+        self._unindexed = []
+        # token -> list of registrations to try, merged from the bucket and
+        # the unindexed ones. Built on first use, cleared on (un)registering.
+        self._lookup = {}
+        self._stats = {}
+        self.profile = None
+        self.metrics = None
+
+
+    def register(self, regex, function, prefix=None):
+        """Register a compiled regex. prefix is the leading token, if None it
+        is worked out from the regex (if possible).
+        """
+        if prefix is None:
+            prefix = literal_token(regex)
+        self._seq += 1
+        reg = [self._seq, regex, function, prefix]
+        if prefix is None:
+            self._unindexed.append(reg)
+        else:
+            self._buckets.setdefault(prefix, []).append(reg)
+        self._lookup = {}
+
+
+    def unregister(self, function):
+        """Remove all registrations of this function."""
+        self._unindexed = [reg for reg in self._unindexed if reg[2] != function]
+        for token, regs in self._buckets.items():
+            regs = [reg for reg in regs if reg[2] != function]
+            if regs:
+                self._buckets[token] = regs
+            else:
+                del self._buckets[token]
+        self._lookup = {}
+
+
+    def _candidates(self, token):
+        try:
+            return self._lookup[token]
+        except KeyError:
+            pass
+        regs = self._buckets.get(token)
+        if regs is None:
+            # Not a known token, only the unindexed ones can match, but
+            # they all share the None entry.
+            if None not in self._lookup:
+                self._lookup[None] = [(reg[1], reg[2]) for reg in self._unindexed]
+            return self._lookup[None]
+        regs = regs + self._unindexed
+        regs.sort()
+        self._lookup[token] = [(reg[1], reg[2]) for reg in regs]
+        return self._lookup[token]
+
+
+    def dispatch(self, data):
+        """Match data against all candidate regexes, call the function of the
+        first match and return (True, its return value). If nothing matches
+        returns (False, None).
+        """
+        token = data.partition(' ')[0]
+        if token not in self._buckets:
+            token = None
+
+        for regex, function in self._candidates(token):
+            match = regex.match(data)
+            if match:
+                try:
+                    self._stats[token][0] += 1
+                except KeyError:
+                    self._stats[token] = [1, 0]
+                if self.profile is None:
+                    return True, function(match)
+                return True, self._profiled(regex, function, match)
+
+        try:
+            self._stats[token][1] += 1
+        except KeyError:
+            self._stats[token] = [0, 1]
+        return False, None
+
+
+    def set_metrics(self, metrics):
+        """Start (or stop if None) collecting timings into metrics. When not
+        collecting, dispatch is not slowed down at all.
+        """
+        self.metrics = metrics
+        if metrics is None:
+            self.__dict__.pop('dispatch', None)
+        else:
+            self.dispatch = self._dispatch_metrics
+
+
+    def _dispatch_metrics(self, data):
+        # Same as dispatch, but timing everything.
+        metrics = self.metrics
+        token = data.partition(' ')[0]
+        if token not in self._buckets:
+            token = None
+
+        for regex, function in self._candidates(token):
+            t = time.time()
+            match = regex.match(data)
+            metrics.pattern(regex.pattern, match is not None, time.time() - t)
+            if match:
+                try:
+                    self._stats[token][0] += 1
+                except KeyError:
+                    self._stats[token] = [1, 0]
+                t = time.time()
+                if self.profile is None:
+                    result = function(match)
+                else:
+                    result = self._profiled(regex, function, match)
+                metrics.handler(function, time.time() - t)
+                return True, result
+
+        try:
+            self._stats[token][1] += 1
+        except KeyError:
+            self._stats[token] = [0, 1]
+        return False, None
+
+
+    def _profiled(self, regex, function, match):
+        t = time.time()
+        result = function(match)
+        t = time.time() - t
+        try:
+            profile = self.profile[regex.pattern]
+        except KeyError:
+            profile = self.profile[regex.pattern] = [0, 0.0]
+        profile[0] += 1
+        profile[1] += t
+        return result
+
+
+    def stats(self):
+        """Return a dictionary token -> [hits, misses]. Blocks that did not
+        have a known token are counted under None.
+        """
+        return dict((token, s[:]) for token, s in self._stats.iteritems())
+
+
+    def __iter__(self):
+        """Iterate over all (regex, function) in registration order."""
+        regs = self._unindexed[:]
+        for bucket in self._buckets.itervalues():
+            regs += bucket
+        regs.sort()
+        return iter([(reg[1], reg[2]) for reg in regs])
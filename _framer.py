@@ -0,0 +1,78 @@
+"""
+Prompt framing for the data read from FICS.
+
+FICS output is delimited by the prompt (with the optional time when ptime is
+set). Large replies (games, who) arrive in many reads, so the framer only
+scans newly arrived data (plus a short overlap for a prompt that was cut in
+two). Reads are collected in one bytearray and a string is only created
+once a prompt actually completes a chunk.
+"""
+
+import datetime
+
+
+class PromptFramer(object):
+    """Split a stream into prompt delimited chunks:
+        o feed(data) -> [(chunk, fics_time), ...] for completed chunks.
+        o pending() -> the data not yet terminated by a prompt.
+        o reset(string) -> forget everything and start with string.
+    fics_time is a datetime.time (in tzinfo) or None, if the prompt did not
+    include the time.
+    
+    data can be a string or anything with the buffer interface. It is copied
+    into one bytearray, strings are only created for completed chunks.
+    """
+
+    def __init__(self, prompt, tzinfo=None, overlap=16):
+        """prompt is the compiled prompt regex, its first two groups must be
+        the hour and minute. overlap must be at least the length of the
+        longest possible prompt minus one. tzinfo can also be a function
+        returning it, which is only called once a prompt with time comes in.
+        """
+        self._prompt = prompt
+        self._tzinfo = tzinfo
+        self._overlap = overlap
+        self.reset()
+
+
+    def reset(self, string=''):
+        # Unterminated data and the position from which it still needs to be
+        # scanned when new data arrives.
+        self._buf = bytearray(string)
+        self._scan = 0
+
+
+    def pending(self):
+        """Return the data that was not yet terminated by a prompt."""
+        return str(self._buf)
+
+
+    def feed(self, data):
+        """Feed newly read data, returns a list of (chunk, fics_time) of all
+        chunks that got completed.
+        """
+        buf = self._buf
+        buf += data
+        matches = list(self._prompt.finditer(buf, self._scan))
+
+        if not matches:
+            self._scan = max(0, len(buf) - self._overlap)
+            return []
+
+        split = []
+        prev = 0
+        for match in matches:
+            hour, minute = match.group(1, 2)
+            if hour:
+                if callable(self._tzinfo):
+                    self._tzinfo = self._tzinfo()
+                t = datetime.time(int(hour), int(minute), tzinfo=self._tzinfo)
+            else:
+                t = None
+            start = match.start()
+            split.append((str(buffer(buf, prev, start - prev)), t))
+            prev = match.end()
+
+        del buf[:prev]
+        self._scan = max(0, len(buf) - self._overlap)
+        return split
@@ -0,0 +1,177 @@
+"""
+Secondary indexes over the items of a Data set, see Data.add_index.
+"""
+
+import weakref
+from bisect import bisect_left, bisect_right, insort
+
+
+class _Index(object):
+    """Base class of the indexes. Items are only weakly referenced, so an
+    item that is dropped by its Data is also dropped from the index.
+        o field: The indexed item name.
+        o key: None or a function converting the value before it is indexed
+           (ie. int for ratings). Values it raises ValueError or TypeError
+           for (and None) are not indexed.
+    """
+
+    def __init__(self, field, key=None):
+        self.field = field
+        self.key = key
+        # id(item) -> (weakref to item, indexed value)
+        self._refs = {}
+
+
+    def __len__(self):
+        return len(self._refs)
+
+
+    def _changed(self, item, name, old, new):
+        # Registered (persistent) with the Data for field.
+        self.discard(item)
+        self.add(item, new)
+
+
+    def add(self, item, value):
+        if value is None:
+            return
+        if self.key is not None:
+            try:
+                value = self.key(value)
+            except (ValueError, TypeError):
+                return
+        try:
+            self._add(id(item), value)
+        except TypeError:
+            # Not hashable.
+            return
+        self._refs[id(item)] = (weakref.ref(item, self._dropped(id(item))), value)
+
+
+    def discard(self, item):
+        entry = self._refs.pop(id(item), None)
+        if entry is not None:
+            self._remove(id(item), entry[1])
+
+
+    def _dropped(self, ident):
+        # Callback for the weakref, self is only weakly referenced so that
+        # removing the index frees it.
+        index = weakref.ref(self)
+        def dropped(ref):
+            self = index()
+            if self is None:
+                return
+            entry = self._refs.get(ident)
+            if entry is not None and entry[0] is ref:
+                del self._refs[ident]
+                self._remove(ident, entry[1])
+        return dropped
+
+
+    def _items(self, idents):
+        items = []
+        for ident in idents:
+            item = self._refs[ident][0]()
+            if item is not None:
+                items.append(item)
+        return items
+
+
+class HashIndex(_Index):
+    """Index mapping each value to its items.
+        o find(value) -> list of items
+    """
+
+    def __init__(self, field, key=None):
+        _Index.__init__(self, field, key)
+        # value -> set of id(item)
+        self._values = {}
+
+
+    def _add(self, ident, value):
+        try:
+            self._values[value].add(ident)
+        except KeyError:
+            self._values[value] = set([ident])
+
+
+    def _remove(self, ident, value):
+        idents = self._values[value]
+        idents.discard(ident)
+        if not idents:
+            del self._values[value]
+
+
+    def find(self, value):
+        if self.key is not None:
+            try:
+                value = self.key(value)
+            except (ValueError, TypeError):
+                return []
+        try:
+            return self._items(list(self._values.get(value, ())))
+        except TypeError:
+            return []
+
+
+class SortedIndex(_Index):
+    """Index keeping the items sorted by value.
+        o find(value) -> list of items
+        o find_range(low=None, high=None) -> list of items with
+           low <= value <= high, sorted by value.
+        o top(n, reverse=True) -> the n items with the highest (or lowest)
+           value.
+    """
+
+    def __init__(self, field, key=None):
+        _Index.__init__(self, field, key)
+        # sorted list of (value, id(item))
+        self._sorted = []
+
+
+    def _add(self, ident, value):
+        insort(self._sorted, (value, ident))
+
+
+    def _remove(self, ident, value):
+        i = bisect_left(self._sorted, (value, ident))
+        del self._sorted[i]
+
+
+    def _bounds(self, low, high):
+        if self.key is not None:
+            if low is not None:
+                low = self.key(low)
+            if high is not None:
+                high = self.key(high)
+        if low is None:
+            start = 0
+        else:
+            start = bisect_left(self._sorted, (low,))
+        if high is None:
+            end = len(self._sorted)
+        else:
+            # Every (high, id) is smaller then (high, inf).
+            end = bisect_right(self._sorted, (high, float('inf')))
+        return start, end
+
+
+    def find(self, value):
+        return self.find_range(value, value)
+
+
+    def find_range(self, low=None, high=None):
+        start, end = self._bounds(low, high)
+        return self._items([ident for value, ident in self._sorted[start:end]])
+
+
+    def top(self, n, reverse=True):
+        if n <= 0:
+            return []
+        if reverse:
+            entries = self._sorted[-n:]
+            entries.reverse()
+        else:
+            entries = self._sorted[:n]
+        return self._items([ident for value, ident in entries])
@@ -0,0 +1,147 @@
+"""
+Counters and latency histograms for IcsBot, see IcsBot.enable_metrics.
+"""
+
+import sys, math
+
+
+class Histogram(object):
+    """Latency histogram with power of two buckets (in microseconds).
+        o add(seconds)
+        o count, total, max
+        o percentile(p) -> upper bound of the bucket the p-th percentile is in.
+    """
+
+    BUCKETS = 32
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * self.BUCKETS
+
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if seconds <= 0:
+            self.buckets[0] += 1
+            return
+        # frexp gives the exponent e with us < 2**e.
+        bucket = math.frexp(seconds * 1e6)[1]
+        if bucket < 0:
+            bucket = 0
+        elif bucket >= self.BUCKETS:
+            bucket = self.BUCKETS - 1
+        self.buckets[bucket] += 1
+
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        needed = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= needed:
+                return min(2**i / 1e6, self.max)
+        return self.max
+
+
+    def as_dict(self):
+        return {'count': self.count, 'total': self.total, 'max': self.max,
+                'p50': self.percentile(50), 'p99': self.percentile(99),
+                'buckets': self.buckets[:]}
+
+
+def _name(function):
+    """A readable name for a handler function."""
+    name = getattr(function, '__name__', None)
+    if name is None:
+        # Callable instances, ie. the PrivateTells.
+        return function.__class__.__name__
+    cls = getattr(function, 'im_class', None)
+    if cls is not None:
+        return '%s.%s' % (cls.__name__, name)
+    return name
+
+
+class Metrics(object):
+    """Collects:
+        o patterns: regex pattern -> [attempts, matches, Histogram of match
+           time (also of failed attempts)]
+        o handlers: handler name -> Histogram of time spend in the handler
+           (reg_comm functions, execute handlers and timers).
+        o executes: command name -> Histogram of the time from sending to the
+           reply being dispatched.
+        o timers: Histogram of how late timers were run.
+    """
+
+    def __init__(self):
+        self.patterns = {}
+        self.handlers = {}
+        self.executes = {}
+        self.timers = Histogram()
+
+
+    def pattern(self, pattern, matched, seconds):
+        try:
+            p = self.patterns[pattern]
+        except KeyError:
+            p = self.patterns[pattern] = [0, 0, Histogram()]
+        p[0] += 1
+        if matched:
+            p[1] += 1
+        p[2].add(seconds)
+
+
+    def handler(self, function, seconds):
+        name = _name(function)
+        try:
+            self.handlers[name].add(seconds)
+        except KeyError:
+            self.handlers[name] = Histogram()
+            self.handlers[name].add(seconds)
+
+
+    def execute(self, command, seconds):
+        name = command.split(None, 1)[0].lower()
+        try:
+            self.executes[name].add(seconds)
+        except KeyError:
+            self.executes[name] = Histogram()
+            self.executes[name].add(seconds)
+
+
+    def timer(self, late):
+        self.timers.add(late)
+
+
+    def as_dict(self):
+        return {'patterns': dict((p, {'attempts': v[0], 'matches': v[1], 'time': v[2].as_dict()})
+                                  for p, v in self.patterns.iteritems()),
+                'handlers': dict((n, h.as_dict()) for n, h in self.handlers.iteritems()),
+                'executes': dict((n, h.as_dict()) for n, h in self.executes.iteritems()),
+                'timers': self.timers.as_dict()}
+
+
+    def dump(self, out=None):
+        """Write a readable summary to out (default sys.stdout)."""
+        if out is None:
+            out = sys.stdout
+        def line(name, h, extra=''):
+            out.write('    %-40s %8d %10.4f %10.6f %10.6f %10.6f%s\n' % (name[:40], h.count, h.total,
+                      h.percentile(50) or 0, h.percentile(99) or 0, h.max, extra))
+        header = '    %-40s %8s %10s %10s %10s %10s' % ('', 'count', 'total', 'p50', 'p99', 'max')
+
+        out.write('Patterns (attempts/matches):\n%s\n' % header)
+        for pattern, (attempts, matches, h) in sorted(self.patterns.iteritems(), key=lambda x: -x[1][2].total):
+            line(pattern, h, ' %s/%s' % (attempts, matches))
+        for title, d in (('Handlers', self.handlers), ('Execute round trips', self.executes)):
+            out.write('%s:\n%s\n' % (title, header))
+            for name, h in sorted(d.iteritems(), key=lambda x: -x[1].total):
+                line(name, h)
+        out.write('Timer lateness:\n%s\n' % header)
+        line('timers', self.timers)
@@ -0,0 +1,141 @@
+"""
+Thread pool to run slow handlers outside of the socket read loop, see
+IcsBot.offload.
+"""
+
+import sys, time, threading, Queue
+
+
+class OffloadPool(object):
+    """A bounded pool of worker threads. Functions are submitted with a name
+    (for the stats), what they return is collected in the order they were
+    submitted, so that the main loop can send it.
+        o wrap(function, name=None) -> function submitting itself when called.
+        o submit(name, function, args, kwargs)
+        o collect() -> (list of return values ready in submission order,
+           None or the sys.exc_info() of a function that raised).
+        o pending() -> number of submitted functions not yet collected.
+        o stats() -> {name: {...}} see below.
+    If the queue is full (max_queue), submitting blocks until a worker is
+    free. Errors raised by a function are returned by collect (after the
+    values of the functions submitted before it).
+
+    The stats for each name are:
+        o calls: How often it was submitted.
+        o queued: How many are currently waiting or running.
+        o max_queued: The maximum of queued.
+        o wait: Total seconds spend waiting for a worker.
+        o run: Total seconds spend running.
+        o max_latency: Maximum time from submitting to the function finishing.
+    """
+
+    def __init__(self, workers=4, max_queue=1000):
+        self.workers = workers
+        self._tasks = Queue.Queue(max_queue)
+        self._threads = []
+        self._lock = threading.Lock()
+
+        # seq -> (ok, result or exc_info) of the finished functions.
+        self._results = {}
+        self._next_seq = 0
+        self._next_collect = 0
+        self._stats = {}
+
+
+    def _start(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+
+    def wrap(self, function, name=None):
+        """Return a function that submits function with its arguments. It
+        returns None, the real return value is collected later.
+        """
+        if name is None:
+            name = getattr(function, '__name__', repr(function))
+        def offloaded(*args, **kwargs):
+            self.submit(name, function, args, kwargs)
+        offloaded.__name__ = name
+        offloaded.__doc__ = function.__doc__
+        return offloaded
+
+
+    def submit(self, name, function, args=(), kwargs={}):
+        if not self._threads:
+            self._start()
+
+        self._lock.acquire()
+        try:
+            seq = self._next_seq
+            self._next_seq += 1
+            try:
+                stats = self._stats[name]
+            except KeyError:
+                stats = self._stats[name] = {'calls': 0, 'queued': 0, 'max_queued': 0, 'wait': 0.0, 'run': 0.0, 'max_latency': 0.0}
+            stats['calls'] += 1
+            stats['queued'] += 1
+            stats['max_queued'] = max(stats['max_queued'], stats['queued'])
+        finally:
+            self._lock.release()
+
+        self._tasks.put((seq, name, function, args, kwargs, time.time()))
+
+
+    def _work(self):
+        while True:
+            seq, name, function, args, kwargs, submitted = self._tasks.get()
+            started = time.time()
+            try:
+                result = (True, function(*args, **kwargs))
+            except:
+                result = (False, sys.exc_info())
+            finished = time.time()
+
+            self._lock.acquire()
+            try:
+                self._results[seq] = result
+                stats = self._stats[name]
+                stats['queued'] -= 1
+                stats['wait'] += started - submitted
+                stats['run'] += finished - started
+                stats['max_latency'] = max(stats['max_latency'], finished - submitted)
+            finally:
+                self._lock.release()
+
+
+    def pending(self):
+        return self._next_seq - self._next_collect
+
+
+    def collect(self):
+        """Return (values, error). values are the return values of all
+        finished functions, stopping at the first one (in submission order)
+        that did not finish yet, or after the first one that raised. error
+        is None or the sys.exc_info() of the one that raised, the values
+        after it are returned by the next call.
+        """
+        collected = []
+        error = None
+        self._lock.acquire()
+        try:
+            while self._next_collect in self._results:
+                ok, result = self._results.pop(self._next_collect)
+                self._next_collect += 1
+                if not ok:
+                    error = result
+                    break
+                collected.append(result)
+        finally:
+            self._lock.release()
+        return collected, error
+
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return dict((name, s.copy()) for name, s in self._stats.iteritems())
+        finally:
+            self._lock.release()
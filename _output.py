@@ -0,0 +1,132 @@
+"""
+Outgoing command queues for IcsBot, see IcsBot.send and IcsBot.SEND_RATE.
+"""
+
+import time
+from collections import deque
+
+# Priority classes, highest first.
+PRIORITIES = ('interactive', 'execute', 'bulk')
+
+
+class OutputQueue(object):
+    """One FIFO queue for each priority class, written in priority order and
+    paced by a token bucket (one token per command).
+        o append(priority, line, execute=None) and extend(priority, lines)
+        o take(rate, burst, force=False) -> (lines that may be written now,
+           the executes given with them).
+        o next_time(rate) -> seconds until the next line may be written, or
+           None if nothing is queued.
+        o stats() -> {priority: {...}}, see IcsBot.output_queue_stats.
+    rate is in commands per second (None for no pacing), burst is the number
+    of commands that may be written at once after being quiet.
+    """
+
+    def __init__(self):
+        self._queues = {}
+        self._stats = {}
+        for priority in PRIORITIES:
+            self._queues[priority] = deque()
+            self._stats[priority] = {'sent': 0, 'max_queued': 0, 'wait': 0.0, 'max_wait': 0.0}
+        self._queued = 0
+        self._tokens = None
+        self._last = time.time()
+
+
+    def append(self, priority, line, execute=None):
+        queue = self._queues[priority]
+        queue.append((time.time(), line, execute))
+        self._queued += 1
+        if len(queue) > self._stats[priority]['max_queued']:
+            self._stats[priority]['max_queued'] = len(queue)
+
+
+    def extend(self, priority, lines):
+        queue = self._queues[priority]
+        t = time.time()
+        for line in lines:
+            queue.append((t, line, None))
+        self._queued += len(lines)
+        if len(queue) > self._stats[priority]['max_queued']:
+            self._stats[priority]['max_queued'] = len(queue)
+
+
+    def clear(self):
+        for queue in self._queues.itervalues():
+            queue.clear()
+        self._queued = 0
+
+
+    def __len__(self):
+        return self._queued
+
+
+    def _refill(self, rate, burst, t):
+        if self._tokens is None:
+            self._tokens = burst
+        else:
+            self._tokens = min(burst, self._tokens + (t - self._last) * rate)
+        self._last = t
+
+
+    def take(self, rate, burst, force=False):
+        """Return the lines that may be written now, highest priority first,
+        and the executes appended with them (see IcsBot._written). With
+        force, everything is returned (the tokens are still used up, but
+        never below 0).
+        """
+        t = time.time()
+        if rate is None or force:
+            n = self._queued
+        else:
+            self._refill(rate, burst, t)
+            n = int(self._tokens)
+        if n <= 0:
+            return [], []
+
+        lines = []
+        executes = []
+        for priority in PRIORITIES:
+            queue = self._queues[priority]
+            if not queue:
+                continue
+            stats = self._stats[priority]
+            while queue and len(lines) < n:
+                queued, line, execute = queue.popleft()
+                wait = t - queued
+                stats['sent'] += 1
+                stats['wait'] += wait
+                if wait > stats['max_wait']:
+                    stats['max_wait'] = wait
+                lines.append(line)
+                if execute is not None:
+                    executes.append(execute)
+            if len(lines) >= n:
+                break
+
+        self._queued -= len(lines)
+        if rate is not None:
+            if self._tokens is None:
+                self._refill(rate, burst, t)
+            self._tokens = max(self._tokens - len(lines), 0)
+        return lines, executes
+
+
+    def next_time(self, rate):
+        """Seconds until the next queued line may be written, or None."""
+        if not self._queued:
+            return None
+        if rate is None or self._tokens is None:
+            return 0
+        tokens = self._tokens + (time.time() - self._last) * rate
+        if tokens >= 1:
+            return 0
+        return (1 - tokens) / rate
+
+
+    def stats(self):
+        stats = {}
+        for priority in PRIORITIES:
+            stats[priority] = self._stats[priority].copy()
+            stats[priority]['queued'] = len(self._queues[priority])
+        return stats
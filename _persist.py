@@ -0,0 +1,109 @@
+"""
+Snapshot and journal files for Data sets, see Data.snapshot, Data.journal
+and Data.restore. Both are marshal files, only values marshal can store
+(None, numbers, strings, and tuples, lists, dicts and sets of them) are
+written, others (ie. datetime objects or other items) are left out.
+"""
+
+import os, marshal
+
+# First entry of a snapshot, to recognize the format.
+FORMAT = 'icsbot data 1'
+
+
+def _storable(values):
+    # The values of an items dictionary marshal can store.
+    storable = {}
+    for name, value in values.iteritems():
+        try:
+            marshal.dumps(value)
+        except ValueError:
+            continue
+        storable[name] = value
+    return storable
+
+
+def write_snapshot(path, main_key, entries):
+    """Write the items dictionaries entries to path. The file is replaced
+    at once, so an old snapshot stays intact if writing fails.
+    """
+    try:
+        data = marshal.dumps((FORMAT, main_key, entries))
+    except ValueError:
+        # Only look at every value if something cannot be stored.
+        data = marshal.dumps((FORMAT, main_key, [_storable(values) for values in entries]))
+    f = open(path + '.tmp', 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(path + '.tmp', path)
+
+
+def read_snapshot(path):
+    """Return (main_key, entries) written by write_snapshot."""
+    f = open(path, 'rb')
+    try:
+        data = marshal.load(f)
+    finally:
+        f.close()
+    if type(data) is not tuple or not data or data[0] != FORMAT:
+        raise ValueError('%s is not an icsbot data snapshot.' % path)
+    return data[1], data[2]
+
+
+class Journal(object):
+    """Append only file of (key, name, value) changes and (key, name)
+    deletions.
+        o record(key, name, value)
+        o delete(key, name)
+        o truncate(): Start over (after a snapshot).
+        o flush() and close()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab')
+
+
+    def record(self, key, name, value):
+        try:
+            self._file.write(marshal.dumps((key, name, value)))
+        except ValueError:
+            pass
+
+
+    def delete(self, key, name):
+        self._file.write(marshal.dumps((key, name)))
+
+
+    def truncate(self):
+        self._file.close()
+        self._file = open(self.path, 'wb')
+
+
+    def flush(self):
+        self._file.flush()
+
+
+    def close(self):
+        self._file.close()
+
+
+def read_journal(path):
+    """Iterate over the (key, name, value) changes and (key, name)
+    deletions in the journal at path. A broken last record (ie. after a
+    crash) ends it.
+    """
+    if not os.path.exists(path):
+        return
+    f = open(path, 'rb')
+    try:
+        while True:
+            try:
+                record = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                return
+            yield record
+    finally:
+        f.close()
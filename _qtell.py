@@ -28,12 +28,19 @@ All sending things support use_next, so you can have it ignore the height.
 (set it to 9999 for that qtell.)
 """
 
-try:
-    import unidecode as _unidecode
-except:
-    print 'No unidecode found, will not try to transliterate utf-8'
-    print 'To get unidecode search for it on pypi, this function is not needed!'
-    _unidecode = None
+_unidecode = []
+
+def _get_unidecode():
+    # unidecode is only imported when transliterate is first used.
+    if not _unidecode:
+        try:
+            import unidecode
+            _unidecode.append(unidecode)
+        except ImportError:
+            print 'No unidecode found, will not try to transliterate utf-8'
+            print 'To get unidecode search for it on pypi, this function is not needed!'
+            _unidecode.append(None)
+    return _unidecode[0]
 
 
 class Qtell(object):
@@ -80,9 +87,9 @@ class Qtell(object):
         """
         if type(data) != unicode:
             data = unicode(data, 'utf-8')
-        if transliterate and _unidecode is not None:
+        if transliterate and _get_unidecode() is not None:
             # Make sure we have unicode
-            data =  _unidecode.unidecode(data.encode('utf-8').decode('utf-8'))
+            data =  _get_unidecode().unidecode(data.encode('utf-8').decode('utf-8'))
         
         lines = self._auto_split(data)
         if type(user) is str:
@@ -143,9 +150,10 @@ class Qtell(object):
         if type(user) is str:
             user = users[user]
         
-        if transliterate and _unidecode is not None:
+        if transliterate and _get_unidecode() is not None:
             # Transliterate all:
-            data = (_unidecode.unidecode(unicode(i, 'utf-8')) for i in data)
+            unidecode = _get_unidecode()
+            data = (unidecode.unidecode(unicode(i, 'utf-8')) for i in data)
         
         user['qtell_buffer'] = data
         return self._send(user, use_next=use_next)
@@ -0,0 +1,122 @@
+"""
+Heap based timers for IcsBot.timer and IcsBot.repeat.
+"""
+
+import heapq
+
+
+class Timer(object):
+    """Handle of a timed function, returned by IcsBot.timer and IcsBot.repeat.
+        o cancel(): Make sure the function is not called (again).
+        o epoch: When the function is called next.
+        o interval: None or the seconds between calls for recurring timers.
+        o cancelled: True if cancelled (or done if not recurring).
+        o due: The epoch the timer was due at when it was last run.
+        o owner: The IcsBot that added the timer (what the function returns is
+           send by it).
+    """
+
+    def __init__(self, heap, epoch, function, args, kwargs, interval=None, owner=None):
+        self._heap = heap
+        self.owner = owner
+        self.epoch = epoch
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.interval = interval
+        self.cancelled = False
+        self.due = None
+
+
+    def cancel(self):
+        """Cancel the timer, does nothing if it is already cancelled."""
+        if self.cancelled:
+            return
+        self.cancelled = True
+        self._heap._cancelled += 1
+        self._heap._compact()
+
+
+    def __call__(self):
+        return self.function(*self.args, **self.kwargs)
+
+
+class TimerHeap(object):
+    """Heap of Timer objects. Cancelled timers are only marked and dropped
+    when they come up (or when more then half of the heap is cancelled).
+    """
+
+    def __init__(self):
+        # Entries are [epoch, seq, timer], seq makes sure that timers of the
+        # same time run in the order they were added and that timers are never
+        # compared.
+        self._heap = []
+        self._seq = 0
+        self._cancelled = 0
+
+
+    def add(self, epoch, function, args=(), kwargs={}, interval=None, owner=None):
+        """Add a new timer and return it."""
+        timer = Timer(self, epoch, function, args, kwargs, interval, owner)
+        self._push(timer)
+        return timer
+
+
+    def _push(self, timer):
+        self._seq += 1
+        heapq.heappush(self._heap, [timer.epoch, self._seq, timer])
+
+
+    def _compact(self):
+        # Rebuild the heap if most of it is cancelled timers.
+        if self._cancelled * 2 <= len(self._heap):
+            return
+        self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+        heapq.heapify(self._heap)
+        self._cancelled = 0
+
+
+    def _drop_cancelled(self):
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+            self._cancelled -= 1
+
+
+    def next_time(self):
+        """Return the epoch of the next timer or None."""
+        self._drop_cancelled()
+        if self._heap:
+            return self._heap[0][0]
+        return None
+
+
+    def pop_due(self, t):
+        """Return the next timer that is due at time t or None. Recurring
+        timers are scheduled again before they are returned.
+        """
+        self._drop_cancelled()
+        if not self._heap or self._heap[0][0] > t:
+            return None
+
+        timer = heapq.heappop(self._heap)[2]
+        timer.due = timer.epoch
+        if timer.interval is None:
+            timer.cancelled = True
+        else:
+            timer.epoch += timer.interval
+            # If we are late, do not try to catch up.
+            if timer.epoch <= t:
+                timer.epoch = t + timer.interval
+            self._push(timer)
+        return timer
+
+
+    def remove(self, match):
+        """Cancel all timers for which match(timer) is True."""
+        for entry in self._heap:
+            if not entry[2].cancelled and match(entry[2]):
+                entry[2].cancel()
+
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
@@ -0,0 +1,224 @@
+"""
+Some small benchmarks for the hot paths of the bot. Run with:
+    python -m icsbot.misc.bench [name ...]
+Without names all benchmarks are run. Benchmarks with a budget (startup)
+make the exit status 1 if it is exceeded.
+"""
+
+import sys, os, time, re, random
+
+# Milliseconds a cold "import icsbot" plus IcsBot() may take.
+STARTUP_BUDGET = 20
+
+
+def _who_reply(size=1024*1024):
+    """Create a fake who IbslwBzSLx reply of about size bytes."""
+    lines = []
+    length = 0
+    i = 0
+    r = random.Random(0)
+    while length < size:
+        ratings = ' '.join([str(r.randint(1000, 2500)) for j in xrange(9)])
+        line = 'User%s(0%s)%s' % (i, r.randint(0, 9), ratings)
+        lines.append(line)
+        length += len(line) + 2
+        i += 1
+    return '\x151\x16137\x16' + '\n\r'.join(lines) + '\n\r%s players displayed.\x17' % i + '\n\rfics% '
+
+
+def _old_framing(prompt, reads):
+    # The framing as it was done before icsbot._framer.
+    buf = ''
+    chunks = []
+    for string in reads:
+        buf = buf + string
+        prev = 0
+        for match in prompt.finditer(buf):
+            chunks.append(buf[prev:match.start()])
+            prev = match.end()
+        buf = buf[prev:]
+    return chunks
+
+
+def _new_framing(prompt, reads):
+    import icsbot._framer
+    framer = icsbot._framer.PromptFramer(prompt)
+    chunks = []
+    for string in reads:
+        chunks.extend([chunk for chunk, t in framer.feed(string)])
+    return chunks
+
+
+def bench_framing(read_size=2048):
+    """Frame a 1 MB who reply arriving in read_size reads."""
+    prompt = re.compile('\n\r(?:(\d\d):(\d\d)_)?fics% ')
+    data = _who_reply()
+    reads = [data[i:i+read_size] for i in xrange(0, len(data), read_size)]
+
+    t = time.time()
+    old = _old_framing(prompt, reads)
+    t_old = time.time() - t
+
+    t = time.time()
+    new = _new_framing(prompt, reads)
+    t_new = time.time() - t
+
+    assert old == new, 'The framing differs.'
+    print 'framing %s bytes in %s reads:' % (len(data), len(reads))
+    print '    old: %.4f s' % t_old
+    print '    new: %.4f s' % t_new
+
+
+def _serve(data):
+    # Send data from a thread over a socketpair, returns the reading end.
+    import socket, threading
+    a, b = socket.socketpair()
+    def write():
+        a.sendall(data)
+        a.close()
+    threading.Thread(target=write).start()
+    return b
+
+
+def bench_receive(read_size=2048):
+    """Read and frame a 4 MB reply from a socket, always reading read_size
+    bytes against the bots _read, which starts with read_size and grows its
+    reads up to MAX_READ_SIZE while they are filled. Both use recv and the
+    same framing, only the read size differs.
+    """
+    import icsbot, icsbot._framer
+    prompt = re.compile('\n\r(?:(\d\d):(\d\d)_)?fics% ')
+    data = _who_reply() * 4
+
+    def run(read):
+        framer = icsbot._framer.PromptFramer(prompt)
+        reads = chunks = 0
+        t = time.time()
+        while True:
+            string = read()
+            if not string:
+                break
+            reads += 1
+            chunks += len(framer.feed(string))
+        return time.time() - t, reads, chunks
+
+    s = _serve(data)
+    t_fixed, reads_fixed, chunks_fixed = run(lambda: s.recv(read_size))
+    s.close()
+
+    bot = icsbot.IcsBot()
+    bot.READ_SIZE = read_size
+    bot.ics = _serve(data)
+    t_adaptive, reads_adaptive, chunks_adaptive = run(bot._read)
+    bot.ics.close()
+
+    assert chunks_fixed == chunks_adaptive == 4
+    print 'receiving %s bytes:' % len(data)
+    print '    %s at a time: %.4f s (%s reads)' % (read_size, t_fixed, reads_fixed)
+    print '    up to %s:  %.4f s (%s reads)' % (bot.MAX_READ_SIZE, t_adaptive, reads_adaptive)
+
+
+def _gc_frozen(func):
+    # The decorator the item accessors were wrapped in before pinning.
+    import gc
+    def new_func(*args, **kwargs):
+        status = gc.isenabled()
+        gc.disable()
+        output = func(*args, **kwargs)
+        if status is True:
+            gc.enable()
+        return output
+    return new_func
+
+
+def bench_items(n=200000):
+    """Get and set item fields, with the garbage collector toggled around
+    every access (as before) against the plain accessors.
+    """
+    import icsbot._data
+
+    data = icsbot._data.Data()
+    class Frozen(data.Item):
+        __getitem__ = _gc_frozen(data.Item.__getitem__.im_func)
+        __setitem__ = _gc_frozen(data.Item.__setitem__.im_func)
+    data.register('online', lambda item, name, old, new: None)
+
+    def run(item):
+        t = time.time()
+        for i in xrange(n):
+            item['online'] = i & 1
+            item['online']
+            item['rating']
+        return time.time() - t
+
+    plain = data['user']
+    plain['rating'] = 1500
+    frozen = Frozen('frozen')
+    frozen['rating'] = 1500
+    t_old = run(frozen)
+    t_new = run(plain)
+
+    print '%s sets and %s gets of item fields:' % (n, 2 * n)
+    print '    gc toggled: %.4f s' % t_old
+    print '    pinning:    %.4f s' % t_new
+
+
+_STARTUP = """
+import time
+t = time.time()
+import icsbot
+imported = time.time()
+icsbot.IcsBot()
+created = time.time()
+print '%f %f' % ((imported - t) * 1000, (created - imported) * 1000)
+"""
+
+
+def bench_startup(runs=7):
+    """Time import icsbot and IcsBot() in fresh processes (the median of
+    runs) and check them against STARTUP_BUDGET.
+    """
+    import subprocess
+    # The directory the icsbot package is in.
+    path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([path] + [p for p in [env.get('PYTHONPATH')] if p])
+
+    times = []
+    for i in xrange(runs):
+        p = subprocess.Popen([sys.executable, '-c', _STARTUP], env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out = p.communicate()[0]
+        if p.returncode:
+            raise RuntimeError('Startup benchmark failed.')
+        times.append([float(x) for x in out.split()[-2:]])
+    times.sort(key=sum)
+    imported, created = times[len(times) // 2]
+
+    print 'startup (median of %s):' % runs
+    print '    import icsbot: %.1f ms' % imported
+    print '    IcsBot():      %.1f ms' % created
+    ok = imported + created <= STARTUP_BUDGET
+    if ok:
+        print '    within the budget of %s ms' % STARTUP_BUDGET
+    else:
+        print '    OVER the budget of %s ms' % STARTUP_BUDGET
+    return ok
+
+
+BENCHMARKS = {'framing': bench_framing, 'receive': bench_receive, 'startup': bench_startup,
+              'items': bench_items}
+
+
+def main(names):
+    if not names:
+        names = sorted(BENCHMARKS)
+    status = 0
+    for name in names:
+        if BENCHMARKS[name]() is False:
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
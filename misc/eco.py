@@ -1,15 +1,28 @@
 """
+ECO codes and opening names. The data is loaded from the eco.dat next to
+this module when it is first needed (or when load() is called). After that
+info, tree and ecos are available as module attributes.
 """
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
+import os
 
-try:
-    info, tree, ecos  = pickle.load(file('eco.dat'))
-except:
-    raise ImportError('Failed to load eco.dat, please create it with create_eco_dat.py')
+info = tree = ecos = None
+
+def load():
+    """Load eco.dat, only the first call actually reads it."""
+    global info, tree, ecos
+    if tree is not None:
+        return
+    try:
+        import cPickle as pickle
+    except ImportError:
+        import pickle
+    
+    filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'eco.dat')
+    try:
+        info, tree, ecos  = pickle.load(file(filename, 'rb'))
+    except Exception:
+        raise IOError('Failed to load %s, please create it with create_eco_dat.py' % filename)
 
 def from_moves(moves):
     """Returns a list of tuples
@@ -22,6 +35,7 @@ def from_moves(moves):
     
     moves can be a (unicode) string or an iterable.
     """
+    load()
     if type(moves) is str or type(moves) is unicode:
         moves = moves.split()
     
@@ -42,6 +56,7 @@ def eco(code):
     """Return the information on an eco, or return a list of all ecos, ordered
     by variation number.
     """
+    load()
     code = code.split('.')
     if len(code) == 1:
         return ecos[code[0]]
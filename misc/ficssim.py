@@ -0,0 +1,554 @@
+"""
+A small FICS simulator to load and soak test bots without network. It speaks
+enough of FICS for IcsBot.connect and the shipped modules:
+    o Login as guest or registered handle (any password is accepted).
+    o iset block 1 block mode, the defprompt prompt.
+    o iset pin 1 <wa>/<wd> notifications, set gin 1 {Game ...} notifications.
+    o who (in the IbslwBzSLx format), games, moves/smoves, observe (style12),
+       tell/qtell/xtell, finger, set/iset and quit.
+Users log in and out and games start and end at configurable rates.
+
+Run with:
+    python -m icsbot.misc.ficssim [--port 5000] [--users 2000] [--online 500]
+        [--logins 600] [--games 300] [--seed N]
+where --logins and --games are events per minute (a login and logout each
+count as one) and --users is the size of the user pool of which --online are
+logged in at the start. Then use IcsBot.connect(ics='localhost', port=5000).
+"""
+
+import sys, time, random, socket, select, errno, re
+
+PROMPT = '\n\rfics% '
+BLOCK_START = '\x15'
+BLOCK_SEPARATOR = '\x16'
+BLOCK_END = '\x17'
+
+# Block codes of the commands we know, all others get 0.
+CODES = {'finger': 37, 'games': 43, 'iset': 65, 'moves': 77, 'observe': 80,
+         'qtell': 103, 'quit': 103, 'set': 124, 'smoves': 154, 'tell': 132,
+         'who': 138, 'xtell': 135}
+
+VARIANTS = [('b', 'blitz', 3, 0), ('l', 'lightning', 1, 0), ('s', 'standard', 15, 5)]
+
+MOVES = ['e4', 'e5', 'Nf3', 'Nc6', 'Bb5', 'a6', 'Ba4', 'Nf6', 'O-O', 'Be7',
+         'Re1', 'b5', 'Bb3', 'd6', 'c3', 'O-O', 'h3', 'Nb8', 'd4', 'Nbd7']
+
+INITIAL = ['rnbqkbnr', 'pppppppp', '--------', '--------', '--------',
+           '--------', 'PPPPPPPP', 'RNBQKBNR']
+
+HANDLE = re.compile('^[a-zA-Z]{3,17}$')
+
+
+def _name(i):
+    letters = []
+    while True:
+        letters.append(chr(ord('a') + i % 26))
+        i //= 26
+        if not i:
+            break
+    return 'Sim' + ''.join(letters)
+
+
+class User(object):
+    def __init__(self, handle, r):
+        self.handle = handle
+        self.ratings = [r.randint(800, 2500) for i in xrange(9)]
+        self.online = False
+        self.game = None
+
+    def who_line(self):
+        # Matches the who IbslwBzSLx (and <wa>) parsing of icsbot.status.
+        return '%s 00%s ' % (self.handle, ' '.join([str(i) for i in self.ratings]))
+
+
+class Game(object):
+    def __init__(self, number, white, black, variant, start):
+        self.number = number
+        self.white = white
+        self.black = black
+        self.variant = variant
+        self.start = start
+        self.moves = 0
+        self.observers = set()
+
+    def style12(self, relation=0):
+        v = self.variant
+        move = self.moves and MOVES[(self.moves - 1) % len(MOVES)] or 'none'
+        to_move = 'BW'[self.moves % 2 == 0]
+        return '<12> %s %s -1 1 1 1 1 0 %s %s %s %s %s %s 39 39 %s %s %s none (0:00.000) %s 0 1 0' % (
+            ' '.join(INITIAL), to_move, self.number, self.white.handle,
+            self.black.handle, relation, v[2], v[3], v[2] * 60000, v[2] * 60000,
+            self.moves // 2 + 1, move)
+
+
+class Client(object):
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.inbuf = ''
+        self.outbuf = []
+        self.state = 'login'
+        self.handle = None
+        self.block = False
+        self.ivars = set()
+        self.vars = set()
+
+
+    def write(self, data):
+        self.outbuf.append(data)
+
+
+    def output(self, text, id_=None, command=''):
+        """Send a command reply (in block mode if on) followed by a prompt."""
+        if self.block and id_ is not None:
+            code = CODES.get(command, 0)
+            text = '%s%s%s%s%s%s%s' % (BLOCK_START, id_, BLOCK_SEPARATOR, code, BLOCK_SEPARATOR, text, BLOCK_END)
+        self.write(text + PROMPT)
+
+
+    def notify(self, text):
+        self.write('\n\r' + text + PROMPT)
+
+
+    def handle_line(self, line):
+        line = line.rstrip('\r')
+        if self.state == 'login':
+            handle = line.strip()
+            if handle.lower() == 'guest':
+                self.handle = self.server.guest_name()
+                self.tags = '(U)'
+                self.write('Press return to enter the server as "%s":\n\r' % self.handle)
+                self.state = 'guest'
+            elif not HANDLE.match(handle):
+                self.write('Sorry, names can only consist of lower and upper case letters.\n\rlogin: ')
+            else:
+                self.handle = handle
+                self.tags = '(TD)'
+                self.write('\n\r"%s" is a registered name.\n\rpassword: ' % handle)
+                self.state = 'password'
+        elif self.state in ('guest', 'password'):
+            if self.server.password is not None and self.state == 'password' and line != self.server.password:
+                self.write('\n\r**** Invalid password! ****\n\r')
+                self.server.drop(self)
+                return
+            self.state = 'session'
+            self.write('\n\r**** Starting FICS session as %s%s ****\n\r' % (self.handle, self.tags))
+            self.write(PROMPT)
+        else:
+            self.command(line)
+
+
+    def command(self, line):
+        id_ = None
+        if self.block:
+            try:
+                id_, line = line.split(' ', 1)
+            except ValueError:
+                id_, line = line, ''
+        line = line.strip().lstrip('$')
+        if not line:
+            self.output('', id_)
+            return
+        parts = line.split(None, 1)
+        command = parts[0].lower()
+        args = parts[1:] and parts[1] or ''
+        handler = getattr(self, 'c_' + command, None)
+        if handler is None:
+            self.output('%s: Command not found.' % command, id_, command)
+            return
+        text = handler(args)
+        if text is not None:
+            self.output(text, id_, command)
+
+
+    def c_iset(self, args):
+        var, value = (args.split(None, 1) + [''])[:2]
+        var = var.lower()
+        if var == 'block':
+            # The reply to iset block is not in block mode yet.
+            self.output('%s set.' % var)
+            self.block = value.strip() == '1'
+            return
+        if value.strip() == '1':
+            self.ivars.add(var)
+        else:
+            self.ivars.discard(var)
+        return '%s set.' % var
+
+
+    def c_set(self, args):
+        var, value = (args.split(None, 1) + [''])[:2]
+        var = var.lower()
+        if value.strip() == '1':
+            self.vars.add(var)
+        else:
+            self.vars.discard(var)
+        return '%s set to %s.' % (var, value.strip())
+
+
+    def c_who(self, args):
+        users = self.server.online_users()
+        lines = [u.who_line() for u in users]
+        lines.append('')
+        lines.append('%s players displayed (of %s). (*) indicates system administrator.' % (len(users), len(users)))
+        return '\n\r'.join(lines)
+
+
+    def c_games(self, args):
+        games = sorted(self.server.games.values(), key=lambda g: g.number)
+        if not games:
+            return 'No matching games were found (of 0 in progress).'
+        lines = []
+        for g in games:
+            lines.append('%3d %4d %-11s %4d %-10s [ %sr %3d %3d]   %d:00 -  %d:00 (39-39) %s: %2d' % (
+                g.number, g.white.ratings[0], g.white.handle[:11],
+                g.black.ratings[0], g.black.handle[:10], g.variant[0],
+                g.variant[2], g.variant[3], g.variant[2], g.variant[2],
+                'WB'[g.moves % 2], g.moves // 2 + 1))
+        lines.append('')
+        lines.append('  %s games displayed.' % len(games))
+        return '\n\r'.join(lines)
+
+
+    def _movelist(self, game, result='*', longresult='Still in progress'):
+        v = game.variant
+        lines = ['Movelist for game %s:' % game.number, '',
+                 '%s (%s) vs. %s (%s) --- %s' % (game.white.handle, game.white.ratings[0],
+                     game.black.handle, game.black.ratings[0],
+                     time.strftime('%a %b %d, %H:%M GMT %Y', time.gmtime(game.start))),
+                 'Rated %s match, initial time: %s minutes, increment: %s seconds.' % (v[1], v[2], v[3]),
+                 '', 'Move  %-19s %s' % (game.white.handle, game.black.handle),
+                 '----  ----------------   ----------------']
+        for i in xrange(0, game.moves, 2):
+            black = ''
+            if i + 1 < game.moves:
+                black = '%-7s (0:00.000)' % MOVES[(i + 1) % len(MOVES)]
+            lines.append('%3d.  %-7s (0:00.000)   %s' % (i // 2 + 1, MOVES[i % len(MOVES)], black))
+        lines.append('      {%s} %s' % (longresult, result))
+        return '\n\r'.join(lines)
+
+
+    def c_moves(self, args):
+        arg = args.split(None, 1) and args.split(None, 1)[0] or ''
+        game = None
+        if arg.isdigit():
+            game = self.server.games.get(int(arg))
+        else:
+            user = self.server.users.get(arg.lower())
+            if user is not None:
+                game = user.game
+        if game is None:
+            return 'There is no such game.'
+        return self._movelist(game)
+
+
+    def c_smoves(self, args):
+        arg = args.split(None, 1) and args.split(None, 1)[0] or ''
+        user = self.server.users.get(arg.lower())
+        if user is None:
+            return 'There is no player matching the name %s.' % arg
+        game = self.server.history.get(user.handle)
+        if game is None:
+            return '%s has no history games.' % user.handle
+        return self._movelist(game[0], game[1], game[2])
+
+
+    def c_observe(self, args):
+        arg = args.strip()
+        if not arg.isdigit() or int(arg) not in self.server.games:
+            return 'There is no such game.'
+        game = self.server.games[int(arg)]
+        game.observers.add(self)
+        return 'You are now observing game %s.\n\rGame %s: %s (%s) %s (%s) rated %s %s %s\n\r\n\r%s' % (
+            game.number, game.number, game.white.handle, game.white.ratings[0],
+            game.black.handle, game.black.ratings[0], game.variant[1],
+            game.variant[2], game.variant[3], game.style12())
+
+
+    def c_finger(self, args):
+        arg = args.strip() or self.handle
+        user = self.server.users.get(arg.lower())
+        if user is None:
+            return 'There is no player matching the name %s.' % arg
+        status = user.online and 'On for: 1 min   Idle: 0 secs' or 'Last disconnected: never'
+        return 'Finger of %s:\n\r\n\r%s\n\r\n\r          rating\n\rBlitz     %s\n\rStandard  %s\n\rLightning %s' % (
+            user.handle, status, user.ratings[0], user.ratings[1], user.ratings[2])
+
+
+    def c_tell(self, args):
+        target = args.split(None, 1) and args.split(None, 1)[0] or ''
+        self.server.told += 1
+        return '(told %s)' % target
+
+    c_xtell = c_tell
+
+
+    def c_qtell(self, args):
+        self.server.told += 1
+        return '*qtell %s 0*' % (args.split(None, 1) and args.split(None, 1)[0] or '')
+
+
+    def c_quit(self, args):
+        self.write('\n\rLogging you out.\n\r')
+        self.server.drop(self, flush=True)
+
+
+class Server(object):
+    def __init__(self, host='', port=5000, users=2000, online=500, logins=600, games=300, seed=None, password=None):
+        self.r = random.Random(seed)
+        self.password = password
+        self.logins = logins
+        self.game_rate = games
+
+        self.users = {}
+        for i in xrange(users):
+            user = User(_name(i), self.r)
+            self.users[user.handle.lower()] = user
+        self.offline = set(self.users.values())
+        self.online = set()
+        for user in self.r.sample(list(self.offline), min(online, users)):
+            self._login(user)
+        self.idle = set(self.online)
+
+        self.games = {}
+        self.history = {}
+        self._next_game = 1
+        self._guests = 0
+        self._event_credit = [0.0, 0.0]
+        self.told = 0
+        self.events = 0
+
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(50)
+        self.listener.setblocking(0)
+        self.clients = {}
+
+
+    def guest_name(self):
+        self._guests += 1
+        return 'Guest' + _name(self._guests)[3:].upper()
+
+
+    def online_users(self):
+        users = list(self.online)
+        for client in self.clients.itervalues():
+            if client.state == 'session':
+                user = self.users.get(client.handle.lower())
+                if user is None or not user.online:
+                    users.append(User(client.handle, self.r))
+        return users
+
+
+    def broadcast(self, text, ivar=None, var=None):
+        self.events += 1
+        for client in self.clients.itervalues():
+            if client.state != 'session':
+                continue
+            if ivar is not None and ivar not in client.ivars:
+                continue
+            if var is not None and var not in client.vars:
+                continue
+            client.notify(text)
+
+
+    def _login(self, user):
+        self.offline.discard(user)
+        self.online.add(user)
+        user.online = True
+
+
+    def login(self):
+        if not self.offline:
+            return
+        user = self.r.choice(tuple(self.offline))
+        self._login(user)
+        self.idle.add(user)
+        self.broadcast('<wa> ' + user.who_line().rstrip(), ivar='pin')
+
+
+    def logout(self):
+        if not self.idle:
+            return
+        user = self.r.choice(tuple(self.idle))
+        self.idle.discard(user)
+        self.online.discard(user)
+        self.offline.add(user)
+        user.online = False
+        self.broadcast('<wd> %s' % user.handle, ivar='pin')
+
+
+    def start_game(self):
+        if len(self.idle) < 2:
+            return
+        white, black = self.r.sample(tuple(self.idle), 2)
+        self.idle.discard(white)
+        self.idle.discard(black)
+        game = Game(self._next_game, white, black, self.r.choice(VARIANTS), time.time())
+        self._next_game += 1
+        white.game = black.game = game
+        self.games[game.number] = game
+        self.broadcast('{Game %s (%s vs. %s) Creating rated %s match.}' % (
+            game.number, white.handle, black.handle, game.variant[1]), var='gin')
+
+
+    def end_game(self):
+        if not self.games:
+            return
+        game = self.games.pop(self.r.choice(tuple(self.games)))
+        result, longresult = self.r.choice([
+            ('1-0', '%s resigns' % game.black.handle),
+            ('0-1', '%s forfeits on time' % game.white.handle),
+            ('1/2-1/2', 'Game drawn by mutual agreement')])
+        for user in (game.white, game.black):
+            user.game = None
+            self.history[user.handle] = (game, result, longresult)
+            if user.online:
+                self.idle.add(user)
+        for client in game.observers:
+            if client.sock is not None:
+                client.notify('Removing game %s from observation list.' % game.number)
+        self.broadcast('{Game %s (%s vs. %s) %s} %s' % (
+            game.number, game.white.handle, game.black.handle, longresult, result), var='gin')
+
+
+    def move(self):
+        if not self.games:
+            return
+        game = self.games[self.r.choice(tuple(self.games))]
+        game.moves += 1
+        for client in list(game.observers):
+            if client.sock is None:
+                game.observers.discard(client)
+            else:
+                client.notify(game.style12())
+
+
+    def tick(self, seconds):
+        """Create the events for seconds passed."""
+        self._event_credit[0] += self.logins * seconds / 60.0
+        self._event_credit[1] += self.game_rate * seconds / 60.0
+        while self._event_credit[0] >= 1:
+            self._event_credit[0] -= 1
+            # Keep the number of users online about the same.
+            if self.r.random() < 0.5:
+                self.login()
+            else:
+                self.logout()
+        while self._event_credit[1] >= 1:
+            self._event_credit[1] -= 1
+            if self.r.random() < 0.5:
+                self.start_game()
+            else:
+                self.end_game()
+            self.move()
+
+
+    def accept(self):
+        try:
+            sock, addr = self.listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(0)
+        client = Client(self, sock)
+        self.clients[sock] = client
+        client.write('\n\rWelcome to the simulated Free Internet Chess Server.\n\r\n\rlogin: ')
+
+
+    def drop(self, client, flush=False):
+        if flush:
+            try:
+                client.sock.sendall(''.join(client.outbuf))
+            except socket.error:
+                pass
+        self.clients.pop(client.sock, None)
+        try:
+            client.sock.close()
+        except socket.error:
+            pass
+        client.sock = None
+
+
+    def read(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ''
+        if not data:
+            self.drop(client)
+            return
+        client.inbuf += data
+        while client.sock is not None and '\n' in client.inbuf:
+            line, client.inbuf = client.inbuf.split('\n', 1)
+            client.handle_line(line)
+
+
+    def write(self, client):
+        data = ''.join(client.outbuf)
+        try:
+            sent = client.sock.send(data)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.drop(client)
+            return
+        if sent < len(data):
+            client.outbuf = [data[sent:]]
+        else:
+            client.outbuf = []
+
+
+    def serve(self, duration=None, resolution=0.05):
+        """Serve (forever or duration seconds)."""
+        start = last = time.time()
+        while duration is None or time.time() - start < duration:
+            readers = [self.listener] + self.clients.keys()
+            writers = [s for s, c in self.clients.iteritems() if c.outbuf]
+            try:
+                r, w, x = select.select(readers, writers, [], resolution)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for sock in r:
+                if sock is self.listener:
+                    self.accept()
+                elif sock in self.clients:
+                    self.read(self.clients[sock])
+            for sock in w:
+                if sock in self.clients:
+                    self.write(self.clients[sock])
+
+            now = time.time()
+            self.tick(now - last)
+            last = now
+
+
+def main(args):
+    options = {'host': '', 'port': 5000, 'users': 2000, 'online': 500,
+               'logins': 600, 'games': 300, 'seed': None, 'password': None}
+    ints = ('port', 'users', 'online', 'logins', 'games', 'seed')
+    while args:
+        name = args.pop(0)
+        if not name.startswith('--') or name[2:] not in options or not args:
+            print __doc__
+            return 1
+        value = args.pop(0)
+        if name[2:] in ints:
+            value = int(value)
+        options[name[2:]] = value
+
+    server = Server(**options)
+    print 'Serving on port %s with %s of %s users online.' % (options['port'], len(server.online), len(server.users))
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        print '%s events broadcast, %s tells received.' % (server.events, server.told)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
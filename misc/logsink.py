@@ -0,0 +1,180 @@
+"""
+A log file which is written from a background thread and rotated by size
+and/or age. Meant for IcsBot(unmatched_log=RotatingLog('unmatched.log')), so
+that a slow disk never stalls the bot.
+"""
+
+import os, re, time, threading, Queue, gzip
+
+_STOP = object()
+
+
+class RotatingLog(object):
+    """File like object (only write, flush and close) writing in a background
+    thread. Every write is one entry and gets a newline appended.
+
+    KWARGS:
+        max_bytes = Rotate when the file gets larger (default 10 MB, None for
+                      no size limit).
+        max_age   = Rotate when the file is older (in seconds, default None).
+        backups   = Number of rotated files to keep (default 5).
+        compress  = gzip the rotated files (default False).
+        max_queue = Number of entries that may wait to be written. If the disk
+                      cannot keep up, further entries are dropped (and counted
+                      in self.dropped) instead of blocking.
+
+    Rotated files are named filename.YYYYmmdd-HHMMSS(-N)(.gz), only those
+    are removed when there are more then backups.
+
+    Errors writing or rotating are printed and counted in self.errors, the
+    thread keeps going (and opens the file again if needed).
+    """
+
+    def __init__(self, filename, max_bytes=10*1024*1024, max_age=None, backups=5, compress=False, max_queue=10000):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backups = backups
+        self.compress = compress
+        self.dropped = 0
+        self.errors = 0
+        self._rotated = re.compile(re.escape(os.path.basename(filename)) + r'\.(\d{8}-\d{6})(?:-(\d+))?(?:\.gz)?$')
+
+        self._queue = Queue.Queue(max_queue)
+        self._open()
+        self._thread = threading.Thread(target=self._work)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+
+    def write(self, data):
+        try:
+            self._queue.put_nowait(data)
+        except Queue.Full:
+            self.dropped += 1
+
+
+    def flush(self):
+        """Wait until everything written so far is on disk."""
+        event = threading.Event()
+        self._queue.put(event)
+        event.wait()
+
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+
+
+    def _open(self):
+        self._file = file(self.filename, 'ab')
+        self._size = self._file.tell()
+        if self._size:
+            self._opened = os.path.getmtime(self.filename)
+        else:
+            self._opened = time.time()
+
+
+    def _work(self):
+        while True:
+            entry = self._queue.get()
+            # Write everything that is waiting before flushing.
+            while True:
+                if entry is _STOP:
+                    try:
+                        self._file.close()
+                    except Exception, e:
+                        self._error(e)
+                    return
+                if isinstance(entry, threading._Event):
+                    try:
+                        try:
+                            self._file.flush()
+                        except Exception, e:
+                            self._error(e)
+                    finally:
+                        # Never leave flush() waiting.
+                        entry.set()
+                else:
+                    try:
+                        self._write(entry)
+                    except Exception, e:
+                        self._error(e)
+                try:
+                    entry = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+            try:
+                self._file.flush()
+            except Exception, e:
+                self._error(e)
+
+
+    def _write(self, entry):
+        if type(entry) is unicode:
+            entry = entry.encode('utf-8')
+        self._file.write(entry)
+        self._file.write('\n')
+        self._size += len(entry) + 1
+        if self._should_rotate():
+            self._rotate()
+
+
+    def _error(self, error):
+        self.errors += 1
+        print 'Warning: Writing the log %s failed: %s' % (self.filename, error)
+        if self._file.closed:
+            # ie. rotating failed after closing the file.
+            try:
+                self._open()
+            except Exception:
+                pass
+
+
+    def _should_rotate(self):
+        if self.max_bytes is not None and self._size >= self.max_bytes:
+            return True
+        if self.max_age is not None and time.time() - self._opened >= self.max_age:
+            return True
+        return False
+
+
+    def _rotate(self):
+        self._file.close()
+        rotated = '%s.%s' % (self.filename, time.strftime('%Y%m%d-%H%M%S'))
+        i = 1
+        while os.path.exists(rotated) or os.path.exists(rotated + '.gz'):
+            rotated = '%s.%s-%s' % (self.filename, time.strftime('%Y%m%d-%H%M%S'), i)
+            i += 1
+        os.rename(self.filename, rotated)
+
+        if self.compress:
+            f = file(rotated, 'rb')
+            g = gzip.open(rotated + '.gz', 'wb')
+            try:
+                while True:
+                    data = f.read(65536)
+                    if not data:
+                        break
+                    g.write(data)
+            finally:
+                g.close()
+                f.close()
+            os.remove(rotated)
+
+        self._remove_old()
+        self._open()
+
+
+    def _remove_old(self):
+        directory = os.path.dirname(self.filename) or '.'
+        rotated = []
+        for name in os.listdir(directory):
+            match = self._rotated.match(name)
+            if match is not None:
+                # Sort by time and then counter (as number, -10 is after -2).
+                rotated.append((match.group(1), int(match.group(2) or 0), os.path.join(directory, name)))
+        rotated.sort()
+        if self.backups is not None and len(rotated) > self.backups:
+            for stamp, counter, name in rotated[:len(rotated) - self.backups]:
+                os.remove(name)
@@ -0,0 +1,191 @@
+"""
+Record everything a bot reads from FICS and replay it later without a
+server, ie. for benchmarking the parsing:
+
+    bot.recorder = Recorder('session.rec')
+    bot.connect(...)
+    bot.run()
+
+And then offline (with the same modules/registrations set up):
+
+    bot = icsbot.IcsBot()
+    ...
+    report = replay(bot, 'session.rec')
+
+Or from the command line, which replays with a plain bot including the status
+and gamelist modules:
+    python -m icsbot.misc.replay session.rec [--realtime]
+
+The file format is a header followed by records of a network byte order
+double (time.time() of the read) and unsigned int (length) followed by the
+data read.
+"""
+
+import sys, time, struct
+
+MAGIC = 'ICSREC1\n'
+_RECORD = struct.Struct('!dI')
+
+
+class Recorder(object):
+    """Writes every chunk given to record(data) with a time stamp to a file
+    (name or open file object). Set as IcsBot.recorder.
+    """
+
+    def __init__(self, f):
+        if type(f) is str or type(f) is unicode:
+            f = file(f, 'wb')
+        self._file = f
+        self._file.write(MAGIC)
+
+
+    def record(self, data, t=None):
+        if t is None:
+            t = time.time()
+        if type(data) is unicode:
+            data = data.encode('utf-8')
+        self._file.write(_RECORD.pack(t, len(data)))
+        self._file.write(data)
+
+
+    def flush(self):
+        self._file.flush()
+
+
+    def close(self):
+        self._file.close()
+
+
+def read(f):
+    """Iterate over all (time, data) in a recording (file name or open file
+    object).
+    """
+    if type(f) is str or type(f) is unicode:
+        f = file(f, 'rb')
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a recording.')
+    while True:
+        header = f.read(_RECORD.size)
+        if len(header) < _RECORD.size:
+            return
+        t, length = _RECORD.unpack(header)
+        data = f.read(length)
+        if len(data) < length:
+            return
+        yield t, data
+
+
+class FakeSocket(object):
+    """Stands in for the socket of a replayed bot and keeps everything the
+    bot sends.
+    """
+
+    def __init__(self):
+        self.sent = []
+
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+
+    def settimeout(self, timeout):
+        pass
+
+
+    def close(self):
+        pass
+
+
+    def commands(self):
+        """Return a list of all commands send (with their block id)."""
+        return ''.join(self.sent).splitlines()
+
+
+def replay(icsbot, f, realtime=False):
+    """Feed a recording into icsbot, which must not be connected. The first
+    record has to be the start of the session (as recorded by IcsBot.connect).
+    If realtime is True, the records are fed with the delay they were read
+    with, otherwise as fast as possible.
+
+    Returns a dictionary with:
+        o chunks: The number of records.
+        o bytes: The number of bytes.
+        o blocks: The number of blocks parsed.
+        o seconds: Time spend (without the waiting for realtime).
+        o blocks_per_sec
+        o handlers: {regex pattern: [calls, seconds]}
+        o sent: The list of commands the bot send.
+    """
+    records = read(f)
+    try:
+        start, data = records.next()
+    except StopIteration:
+        raise ValueError('The recording is empty.')
+
+    sock = FakeSocket()
+    dispatcher = icsbot._registered
+    dispatcher.profile = {}
+    blocks_before = sum([s[0] + s[1] for s in dispatcher.stats().itervalues()])
+
+    chunks = 1
+    size = len(data)
+    spent = 0.0
+    clock = time.time()
+
+    t = time.time()
+    icsbot._attach(sock, data)
+    spent += time.time() - t
+    try:
+        for recorded, data in records:
+            if realtime:
+                wait = (recorded - start) - (time.time() - clock)
+                if wait > 0:
+                    time.sleep(wait)
+            t = time.time()
+            icsbot._parse(data)
+            icsbot._run_timers()
+            spent += time.time() - t
+            chunks += 1
+            size += len(data)
+        # Whatever is still waiting for SEND_RATE.
+        icsbot._flush(force=True)
+    finally:
+        handlers = dispatcher.profile
+        dispatcher.profile = None
+
+    blocks = sum([s[0] + s[1] for s in dispatcher.stats().itervalues()]) - blocks_before
+    if spent:
+        rate = blocks / spent
+    else:
+        rate = None
+    return {'chunks': chunks, 'bytes': size, 'blocks': blocks, 'seconds': spent,
+            'blocks_per_sec': rate, 'handlers': handlers, 'sent': sock.commands()}
+
+
+def main(args):
+    import icsbot, icsbot.status, icsbot.parser.gamelist
+    realtime = '--realtime' in args
+    args = [arg for arg in args if arg != '--realtime']
+    if len(args) != 1:
+        print 'Usage: python -m icsbot.misc.replay recording [--realtime]'
+        return 1
+
+    bot = icsbot.IcsBot()
+    icsbot.status.Status(bot)
+    icsbot.parser.gamelist.GameList(bot)
+    report = replay(bot, args[0], realtime=realtime)
+
+    print '%(chunks)s chunks, %(bytes)s bytes, %(blocks)s blocks in %(seconds).3f s' % report
+    if report['blocks_per_sec'] is not None:
+        print '%.0f blocks/sec' % report['blocks_per_sec']
+    print 'Handlers (calls, seconds):'
+    handlers = report['handlers'].items()
+    handlers.sort(key=lambda x: -x[1][1])
+    for pattern, (calls, seconds) in handlers:
+        print '    %8d %8.4f  %s' % (calls, seconds, pattern[:60])
+    print '%s commands send.' % len(report['sent'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
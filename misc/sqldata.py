@@ -110,10 +110,10 @@ class SqlData(object):
         else:
             for value in self.store_values:
                 self.dataset.register(value, self._item_changed)
-                self.dataset.register(value, self._load_all, loader=True)        
+                self.dataset.register(value, self._load_all_batch, loader=True, batch=True)
         
         self.store_values.remove(self.main_key)
-        self.dataset.register('rowid', self._load_all, loader=True)
+        self.dataset.register('rowid', self._load_all_batch, loader=True, batch=True)
         self.dataset.sql = self
         
     
@@ -156,6 +156,40 @@ class SqlData(object):
         data_set.items['rowid'] = id_
         
     
+    def _load_all_batch(self, data_sets, item=None):
+        """Same as _load_all for a list of items, with one query for (up to)
+        500 of them. Registered as batch loader, see Data.prefetch.
+        """
+        if not self.lower:
+            key_column = self.main_key
+            keys = {}
+            for data_set in data_sets:
+                keys.setdefault(data_set.items[self.main_key], []).append(data_set)
+        else:
+            key_column = self.main_key_lower
+            keys = {}
+            for data_set in data_sets:
+                keys.setdefault(data_set.items[self.main_key].lower(), []).append(data_set)
+        
+        # SQLite allows 999 parameters by default.
+        all_keys = keys.keys()
+        for i in xrange(0, len(all_keys), 500):
+            chunk = all_keys[i:i+500]
+            self.dcursor.execute('SELECT %s.rowid as rowid, %s.%s as _icsbot_key, %s FROM %s WHERE %s.%s IN (%s)' % (self.table, self.table, key_column, self.all_columns, self.table_joins, self.table, key_column, ', '.join(['?'] * len(chunk))), chunk)
+            for data in self.dcursor.fetchall():
+                # Remove rowid, so that changing it will create an event.
+                id_ = data.pop('rowid')
+                for data_set in keys.pop(data.pop('_icsbot_key'), ()):
+                    data_set.items.update(data)
+                    data_set.items['rowid'] = id_
+        
+        # Not in the database, fill it up with None like _load_all.
+        for missing in keys.itervalues():
+            for data_set in missing:
+                data_set.items.update((key, None) for key in self.store_values)
+                data_set.items['rowid'] = None
+    
+    
     def _item_changed(self, data_set, item, old, new):
         # Dummy check in case I change internal API of the _data.Item.
         if old == new:
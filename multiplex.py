@@ -0,0 +1,234 @@
+"""
+Module to include the Multiplexer class, which runs several bots (accounts)
+in one process from a single select loop, with one timer heap and optionally
+shared data sets.
+
+    mux = Multiplexer(shared=('users',))
+    td = mux.create()
+    status.Status(td)
+    ...
+    mux.connect(td, 'TDBot', 'password')
+    mux.connect(other, 'OtherBot', 'password')
+    mux.run()
+"""
+
+import time, select, errno, socket
+
+import _timer
+from icsbot import ConnectionClosed
+
+
+class Multiplexer(object):
+    def __init__(self, shared=()):
+        """Initialize the multiplexer. shared is a list of data set names
+        (ie. 'users') that all bots created through create() share. Shared
+        data sets mean that items only exist once. They are created by the
+        first bot using them (with its main_key and buffer size). The Status
+        module only gets the who list for the first bot using the shared
+        users.
+
+        NOTE:
+            o Only create one GameList for a shared sgames data set.
+            o on_close(icsbot, exception) is called when a bot's connection
+                is closed or fails with a socket.error (the bot is removed
+                then, the others keep running). The default prints it. If no
+                bot is left, run returns.
+            o A handler or timer may close another bot, that bot is closed
+                once the handler returned (see _sweep).
+        """
+        self._timers = _timer.TimerHeap()
+        # name -> Data, None until a bot used it (see IcsBot data_sets).
+        self.shared = {}
+        for name in shared:
+            self.shared[name.lower()] = None
+        self._bots = {}
+        self._last_read = {}
+        # The bot whose handler or timer is running (see _guard), and bots
+        # closed by another one's, which _sweep closes.
+        self._current = None
+        self._closing = []
+        self.on_close = self._print_close
+
+
+    def create(self, *args, **kwargs):
+        """Create an IcsBot using the shared data sets and timers. Arguments
+        are passed on to IcsBot.
+        """
+        import icsbot
+        kwargs['data_sets'] = self.shared
+        bot = icsbot.IcsBot(*args, **kwargs)
+        self.add(bot)
+        return bot
+
+
+    def add(self, icsbot):
+        """Use the shared timers for an existing bot. Its timers are moved.
+        (Use create to also use the shared data sets.)
+        """
+        icsbot._multiplexer = self
+        old = icsbot._timers
+        icsbot._timers = self._timers
+        for epoch, seq, timer in sorted(old._heap):
+            if not timer.cancelled:
+                timer._heap = self._timers
+                self._timers._push(timer)
+
+
+    def connect(self, icsbot, *args, **kwargs):
+        """Connect the bot (IcsBot.connect arguments) and serve it in run."""
+        icsbot._multiplexer = self
+        icsbot.connect(*args, **kwargs)
+        self._bots[icsbot.ics] = icsbot
+        self._last_read[icsbot] = time.time()
+
+
+    def remove(self, icsbot):
+        """Stop serving a bot and close its socket (without sending quit,
+        use icsbot.close for that). Its timers are cancelled.
+        """
+        for sock, bot in self._bots.items():
+            if bot is icsbot:
+                del self._bots[sock]
+                sock.close()
+                if getattr(bot, 'ics', None) is sock:
+                    del bot.ics
+        self._last_read.pop(icsbot, None)
+        if icsbot in self._closing:
+            self._closing.remove(icsbot)
+        self._timers.remove(lambda timer: timer.owner is icsbot)
+
+
+    def bots(self):
+        return self._bots.values()
+
+
+    def _print_close(self, icsbot, error):
+        print 'Connection of %s closed: %s' % (icsbot.handle, error)
+
+
+    def _close_later(self, icsbot):
+        """Called by icsbot.close. If another bot's handler or timer is
+        running, mark icsbot to be closed by _sweep and return True, so that
+        the running bot is not unwound by its ConnectionClosed.
+        """
+        if self._current is None or self._current is icsbot:
+            return False
+        if icsbot in self._last_read and icsbot not in self._closing:
+            self._closing.append(icsbot)
+        return True
+
+
+    def _run_timers(self):
+        t = time.time()
+        timer = self._timers.pop_due(t)
+        while timer is not None:
+            self._guard(timer.owner, self._run_timer, t, timer)
+            timer = self._timers.pop_due(t)
+
+        poll = False
+        for bot in self._bots.values():
+            self._guard(bot, bot._collect_offloaded)
+            self._guard(bot, bot._flush)
+            if bot._offload is not None and bot._offload.pending():
+                poll = True
+
+        next = self._timers.next_time()
+        if next is not None:
+            next = max(next - t, 0)
+        for bot in self._bots.values():
+            if poll and (next is None or next > bot.OFFLOAD_POLL):
+                next = bot.OFFLOAD_POLL
+            waiting = bot._output.next_time(bot.SEND_RATE)
+            if waiting is not None and (next is None or waiting < next):
+                next = waiting
+            if bot.TIMEOUT:
+                quiet = bot.TIMEOUT - (t - self._last_read[bot])
+                if next is None or quiet < next:
+                    next = max(quiet, 0)
+        return next
+
+
+    def _run_timer(self, t, timer):
+        bot = timer.owner
+        if bot.metrics is None:
+            bot.send(timer())
+        else:
+            bot.metrics.timer(t - timer.due)
+            started = time.time()
+            bot.send(timer())
+            bot.metrics.handler(timer.function, time.time() - started)
+
+
+    def _check_quiet(self):
+        t = time.time()
+        for bot in self._bots.values():
+            if bot.TIMEOUT and t - self._last_read[bot] >= bot.TIMEOUT:
+                self._guard(bot, bot._timeout)
+
+
+    def _guard(self, bot, function, *args):
+        if bot not in self._last_read:
+            # Removed already (ie. by an earlier timer closing it).
+            return
+        current = self._current
+        self._current = bot
+        try:
+            try:
+                function(*args)
+            except (ConnectionClosed, socket.error), e:
+                # Only this bot is removed, the others keep running.
+                self.remove(bot)
+                self.on_close(bot, e)
+        finally:
+            self._current = current
+
+
+    def _sweep(self):
+        # Bots closed from another bot's handler or timer.
+        while self._closing:
+            bot = self._closing.pop(0)
+            self._guard(bot, bot.close)
+        # Bots whose connection was closed in another way.
+        for sock, bot in self._bots.items():
+            if getattr(bot, 'ics', None) is not sock:
+                self.remove(bot)
+                self.on_close(bot, ConnectionClosed('Closed by us.'))
+
+
+    def _read(self, sock):
+        bot = self._bots[sock]
+        if bot in self._closing:
+            return
+        try:
+            data = bot._read()
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            self.remove(bot)
+            self.on_close(bot, e)
+            return
+        self._last_read[bot] = time.time()
+        if not data:
+            self._guard(bot, bot._closed)
+            return
+        self._guard(bot, bot._parse, data)
+
+
+    def run(self):
+        """Serve all connected bots until all connections are closed."""
+        while self._bots:
+            timeout = self._run_timers()
+            self._sweep()
+            if not self._bots:
+                break
+            try:
+                readable = select.select(self._bots.keys(), [], [], timeout)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for sock in readable:
+                if sock in self._bots:
+                    self._read(sock)
+            self._check_quiet()
+            self._sweep()
@@ -30,7 +30,8 @@ class GameList(object):
         (o game = game number again. Is the handle/main_key!)
     
     NOTE: games command parsing is right now only done to get a starting list
-        of games. Updates are at this time not done.
+        of games, and again after reconnecting to find the games that started
+        or ended in the meantime (see reset).
     
     REQUIRES STATUS TO WORK (REMOVE THE games PARSING IF YOU DON'T WANT THAT)
     
@@ -75,6 +76,7 @@ class GameList(object):
         self._sgames.register('end_time', self._add_usr_info_end)
         if get_games:
             self._icsbot.execute('games', self._grab_games)
+            self._icsbot.reg_reconnect(self.reset)
         
     
     def _add_usr_info_start(self, game, key, old, new):
@@ -107,97 +109,169 @@ class GameList(object):
         # Not that this must go first because we have no buffer.
         self._games.add(self._sgames[game])
         # Then we can:
-        self._sgames[game].items.update(d)
+        self._sgames[game].update(d)
         self._sgames[game]['start_time'] = t
     
     
-    def _grab_games(self, data):
+    def _parse_games(self, data):
+        """Parse the games output. Returns a list of dictionaries (one for
+        each game that could be identified), the set of all game numbers that
+        were listed and wether all games in progress were listed.
+        """
         reg_games = re.compile('((^(?P<data>.*)\n\r  (?P<displayed>\d+) games? displayed( \(of (?P<progress>\d+) in progress\))?\.$)|(^No matching games were found \(of \d+ in progress\)\.$))', re.MULTILINE | re.DOTALL)
         matches = reg_games.match(data)
         variants = {'n': 'non standard', 'w': 'wild', 'b': 'blitz', 's': 'standard', 'l': 'lightning', 'B': 'bughouse', 'x': 'atomic', 'z': 'crazyhouse', 'L': 'losers', 'S': 'suicide', 'u': 'untimed'}
         M = matches.groupdict()
+        
+        games = []
+        listed = set()
+        if M['data'] is None:
+            # No matching games were found.
+            return games, listed, True
+        
+        data = M['data']
+        r = re.compile('^\s*(?P<gamenumber>[\d]+) +(?P<w_rating>(?:\d+|\+{4,4}|-{4,4})) (?P<white>[a-zA-Z]+) +(?P<b_rating>(?:\d+|\+{4,4}|-{4,4})) (?P<black>[a-zA-Z]+) +\[(?P<private>(?:p| ))(?P<variant>[A-z])(?P<rated>(?:r|u)) *(?P<time>[\d]+) +(?P<inc>[\d]+)\][^(]+\( ?(?P<w_material>[\d]+)- ?(?P<b_material>[\d]+)\) .: *(?P<move>[\d]+)\s*$', re.MULTILINE)
+        
+        matches = r.findall(data)
+        
+        handles = [user['handle'] for user in self._icsbot['users'].online]
+        handles.sort()
 
-        if M.has_key('data'):
-            data = M['data']
-            r = re.compile('^\s*(?P<gamenumber>[\d]+) +(?P<w_rating>(?:\d+|\+{4,4}|-{4,4})) (?P<white>[a-zA-Z]+) +(?P<b_rating>(?:\d+|\+{4,4}|-{4,4})) (?P<black>[a-zA-Z]+) +\[(?P<private>(?:p| ))(?P<variant>[A-z])(?P<rated>(?:r|u)) *(?P<time>[\d]+) +(?P<inc>[\d]+)\][^(]+\( ?(?P<w_material>[\d]+)- ?(?P<b_material>[\d]+)\) .: *(?P<move>[\d]+)\s*$', re.MULTILINE)
+        white = {}
+        black = {}
+        for handle in handles:
+            if white.has_key(handle[:11].lower()):
+                # In this case we cannot uniquely say who is playing the
+                # game. We will just drop those rare games lateron.
+                white[handle[:11].lower()] = None
+            else:
+                white[handle[:11].lower()] = handle
             
-            matches = r.findall(data)
+            if black.has_key(handle[:10].lower()):
+                # In this case we cannot uniquely say who is playing the
+                # game. We will just drop those rare games lateron.
+                black[handle[:10].lower()] = None
+            else:
+                black[handle[:10].lower()] = handle
+        
+        for match in matches:
+            d = {}
+            d['game'] = int(match[0])
+            listed.add(d['game'])
+            if match[1] == '++++' or match[1] == '----':
+                d['w_rating'] = None
+            else:
+                d['w_rating'] = int(match[1])
             
-            handles = [user['handle'] for user in self._icsbot['users'].online]
-            handles.sort()
-
-            white = {}
-            black = {}
-            for handle in handles:
-                if white.has_key(handle[:11].lower()):
-                    # In this case we cannot uniquely say who is playing the
-                    # game. We will just drop those rare games lateron.
-                    white[handle[:11].lower()] = None
-                else:
-                    white[handle[:11].lower()] = handle
-                
-                if black.has_key(handle[:10].lower()):
-                    # In this case we cannot uniquely say who is playing the
-                    # game. We will just drop those rare games lateron.
-                    black[handle[:10].lower()] = None
-                else:
-                    black[handle[:10].lower()] = handle
+            d['white'] = white.get(match[2].lower())
+            if d['white'] is None:
+                print 'Warning: Game %s is considered not existent because of ambiguous whites handle: %s' % (d['game'], match[2])
+                continue
             
-            for match in matches:
-                d = {}
-                d['game'] = int(match[0])
-                if match[1] == '++++' or match[1] == '----':
-                    d['w_rating'] = None
-                else:
-                    d['w_rating'] = int(match[1])
-                
-                d['white'] = white[match[2].lower()]
-                if d['white'] is None:
-                    print 'Warning: Game %s is considered not existent because of ambiguous whites handle: %s' % (d['game'], match[2])
-                    continue
-                
-                if match[3] == '++++' or match[3] == '----':
-                    d['b_rating'] = None
-                else:
-                    d['b_rating'] = int(match[3])
-                
-                d['black'] = black[match[4].lower()]
-                if d['black'] is None:
-                    print 'Warning: Game %s is considered not existent because of ambiguous blacks handle: %s' % (d['game'], match[4])
-                    continue  
-                
-                if matches[5] == 'p':
-                    d['private'] = True
-                else:
-                    d['private'] = False
-                
-                d['variant'] = variants[match[6]]
-                
-                if matches[7] == 'r':
-                    d['rated'] = True
-                else:
-                    d['rated'] = False
-                
-                d['time'] = int(match[8])
-                d['inc'] = int(match[9])
-                d['w_material'] = int(match[10])
-                d['b_material'] = int(match[11])
-                d['moves']    = int(match[12])     
-                
-                game = self._sgames[d['game']]
-                # I update d, so that it overwrites anything here thats worse info.
-                d.update(game.items)
-                game.items.update(d)
-                game['update_time'] = time.time()
-                self._games.add(game)
+            if match[3] == '++++' or match[3] == '----':
+                d['b_rating'] = None
+            else:
+                d['b_rating'] = int(match[3])
+            
+            d['black'] = black.get(match[4].lower())
+            if d['black'] is None:
+                print 'Warning: Game %s is considered not existent because of ambiguous blacks handle: %s' % (d['game'], match[4])
+                continue  
+            
+            if match[5] == 'p':
+                d['private'] = True
+            else:
+                d['private'] = False
+            
+            d['variant'] = variants[match[6]]
+            
+            if match[7] == 'r':
+                d['rated'] = True
+            else:
+                d['rated'] = False
+            
+            d['time'] = int(match[8])
+            d['inc'] = int(match[9])
+            d['w_material'] = int(match[10])
+            d['b_material'] = int(match[11])
+            d['moves']    = int(match[12])
+            games.append(d)
+        
+        # If not all games were displayed, we assume there is something wrong.
+        return games, listed, M['progress'] is None
+    
+    
+    def _add_game(self, d, new=False):
+        game = self._sgames[d['game']]
+        if new:
+            # The number was used by an earlier game, none of its info is
+            # valid for this one.
+            d.update({'start_time': None, 'end_time': None, 'result': '*', 'longresult': 'game in progress'})
+        else:
+            # I update d, so that it overwrites anything here thats worse info.
+            d.update(game.items)
+        game.update(d)
+        game['update_time'] = time.time()
+        self._games.add(game)
+    
+    
+    def _grab_games(self, data):
+        games, listed, complete = self._parse_games(data)
+        self._sgames.begin()
+        try:
+            for d in games:
+                self._add_game(d)
+        finally:
+            self._sgames.commit()
+        
+        # In case this was not the first time, we need to check what the
+        # status is.
+        if not self.status['got_all'] and complete:
+            self.status['got_all'] = True
+    
+    
+    def reset(self):
+        """Get the games list again, ie. after the bot reconnected (it is
+        registered with icsbot.reg_reconnect). The games that ended in the
+        meantime get their end_time set (their result stays unknown) and the
+        ones that started get update_time set, also when FICS gave an ended
+        game's number to a new one (the players differ). Games that are still
+        running do not trigger anything.
+        """
+        self.status['got_all'] = False
+        self._icsbot.execute('games', self._resync_games)
+    
+    
+    def _resync_games(self, data):
+        games, listed, complete = self._parse_games(data)
+        
+        # FICS reuses game numbers, if the players differ the old game ended
+        # in the meantime. This is done before the batch, so that its end is
+        # seen with the old players (and not merged with the new game).
+        replaced = set()
+        for d in games:
+            game = self._sgames[d['game']]
+            if game in self._games and (game['white'] != d['white'] or game['black'] != d['black']):
+                game['end_time'] = datetime.datetime.utcnow()
+                self._games.discard(game)
+                replaced.add(d['game'])
+        
+        self._sgames.begin()
+        try:
+            if complete:
+                for game in list(self._games):
+                    if game['game'] not in listed:
+                        game['end_time'] = datetime.datetime.utcnow()
+                        self._games.discard(game)
             
-            # In case this was not the first time, we need to check what the
-            # status is.
-            if not self.status['got_all']:
-                # We will only update if all games were displayed. Otherwise
-                # we assume there is something wrong, this is the case if:
-                if M['progress'] is None:
-                    self.status['got_all'] = True
+            for d in games:
+                if self._sgames[d['game']] not in self._games:
+                    self._add_game(d, new=d['game'] in replaced)
+        finally:
+            self._sgames.commit()
+        
+        if complete:
+            self.status['got_all'] = True
         
     
     def _end(self, matches):
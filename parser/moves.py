@@ -9,12 +9,6 @@ import icsbot.misc.regex as reg
 
 import datetime
 
-try:
-    import pytz
-    TZINFO = pytz.timezone('UTC')
-except:
-    TZINFO = None
-
 class Moves(object):
     """
     This class initializes movelist parsing for FICS, it does not parse arbitrary
@@ -22,11 +16,18 @@ class Moves(object):
     Moves.get_move('smoves seberg -1', function, *args, **kwargs) for example. The
 
     The class isets ms 1. But it would also work fine with ms=0.
+    
+    Use bulk=True for fetching many movelists, so that the commands go to the
+    bots bulk output queue and do not delay more urgent ones.
     """
     
-    def __init__(self, icsbot, trigger_duplicate=True):
+    def __init__(self, icsbot, trigger_duplicate=True, bulk=False):
         self.regex = re.compile('^(?:Movelist for game (?P<gamenumber>\d+):)?\s*(?P<white>%s) \((?P<wrating>(\d+|UNR))\) vs. (?P<black>%s) \((?P<brating>(\d+|UNR))\) --- (?P<start_time>[^\n]+)\n\r(?P<rated>(Unrated|Rated)) (?P<variant>[^ ]+) match, initial time: (?P<time>\d+) minutes, increment: (?P<inc>\d+) seconds\.\s*\n\rMove [A-z ]+\n\r[- ]+\n\r(?P<data>[^{]+)\{(?P<longresult>[^}]*)\} (?P<result>[^ \n\r]*)' % (reg.HANDLE, reg.HANDLE), re.DOTALL)
         self._icsbot = icsbot
+        if bulk:
+            self._priority = 'bulk'
+        else:
+            self._priority = 'execute'
         self._icsbot.send('iset movecase 1')
         self._icsbot.send('iset ms 1')
         self._icsbot.send('set tzone gmt')
@@ -54,14 +55,14 @@ class Moves(object):
                 It is naive if pytz is not installed.
         Should no moves be retrieved, it executes function(None, *args, **kwargs).
         """
-        self._icsbot.execute(command, self._gotten_moves, function, *args, **kwargs)
+        self._icsbot.execute_priority(self._priority, command, self._gotten_moves, function, *args, **kwargs)
         
 
     def _gotten_moves(self, data, function, *args, **kwargs):
         matches = self.regex.match(data)
     
         if not matches:
-            function(None, *args, **kwargs)
+            return function(None, *args, **kwargs)
 
         d = matches.groupdict()
         
@@ -75,7 +76,9 @@ class Moves(object):
     
         try:
             d['start_time'] = datetime.datetime.strptime(d['start_time'], '%a %b %d, %H:%M GMT %Y')
-            d['start_time'].replace(tzinfo=TZINFO)
+            # pytz is only imported here, when the first movelist is parsed.
+            from icsbot import get_tzinfo
+            d['start_time'] = d['start_time'].replace(tzinfo=get_tzinfo())
         except:
             print 'The timezone of this account is not set to GMT, I need GMT for datetime.datetime'
         
@@ -24,8 +24,11 @@ class Status(object):
         
         NOTE:
             o whoIA is parsed once, after that everything is kept up to date
-                with iset pin 1 info. So if connection is lost, use the
-                reset function.
+                with iset pin 1 info. When the bot reconnects (or reset is
+                called) it is parsed again and only users that really came
+                or left in the meantime get their online item changed.
+            o If the users are shared with a bot that already has a Status,
+                whoIA is not parsed again.
         """
         
         assert icsbot, 'Must give the Main instance.'
@@ -34,15 +37,29 @@ class Status(object):
         self._icsbot = icsbot
         self._users = self._icsbot['users']
         self.status = self._users['__status__']
-        self.status['got_all'] = False
         
-        self._users.online = set()            
+        self.re_connect = re.compile('^<wa> (?P<handle>[a-zA-Z]*).(?P<tags>\d{2})(?P<blitz>\d+)[^0-9](?P<standard>\d+)[^0-9](?P<lightning>\d+)[^0-9](?P<wild>\d+)[^0-9](?P<bughouse>\d+)[^0-9](?P<crazyhouse>\d+)[^0-9](?P<suicide>\d+)[^0-9](?P<losers>\d+)[^0-9](?P<atomic>\d+)[^0-9]?$')
+        self.re_disconnect = '^<wd> (?P<handle>.*)$'
+        
+        # True once the <wa>/<wd> handlers are registered.
+        self._listening = False
         
         self.send('iset pin 1')
-        icsbot.execute('who IbslwBzSLx', self._who_i)
+        icsbot.reg_reconnect(self.reset)
+        if getattr(self._users, 'online', None) is not None:
+            # The users are shared with another bot (see multiplex) whose
+            # Status already gets the who list, so only follow the pin info.
+            self._icsbot.reg_comm(self.re_connect, self._connect)
+            self._icsbot.reg_comm(self.re_disconnect, self._disconnect)
+            self._listening = True
+            return
         
-        self.re_connect = re.compile('^<wa> (?P<handle>[a-zA-Z]*).(?P<tags>\d{2})(?P<blitz>\d+)[^0-9](?P<standard>\d+)[^0-9](?P<lightning>\d+)[^0-9](?P<wild>\d+)[^0-9](?P<bughouse>\d+)[^0-9](?P<crazyhouse>\d+)[^0-9](?P<suicide>\d+)[^0-9](?P<losers>\d+)[^0-9](?P<atomic>\d+)[^0-9]?$')
-        self.re_disconnect = '^<wd> (?P<handle>.*)$'
+        self.status['got_all'] = False
+        # Users restored as online (see Data.restore) are checked against
+        # the who list like after a reconnect.
+        self._users.online = set(self._users.find('online', True))
+        
+        icsbot.execute('who IbslwBzSLx', self._who_i)
 
 
     def _set_tags(self, usr, tags):
@@ -73,23 +90,36 @@ class Status(object):
     def _who_i(self, data):
         pattern = re.compile('^\r?(?P<handle>[a-zA-Z]{3,18}).(?P<tags>\d{2})(?P<blitz>\d+)[^0-9](?P<standard>\d+)[^0-9](?P<lightning>\d+)[^0-9](?P<wild>\d+)[^0-9](?P<bughouse>\d+)[^0-9](?P<crazyhouse>\d+)[^0-9](?P<suicide>\d+)[^0-9](?P<losers>\d+)[^0-9](?P<atomic>\d+)[^0-9]\s*$', re.MULTILINE)
         online = set()
-        for m in pattern.finditer(data):
-            d = m.groupdict()
-            usr = self._users[d['handle']]
-            online.add(usr)
-            usr.items.update(d)
-            self._set_tags(usr, d['tags'])
-            usr['online'] = True
+        # The registered functions are called once everything is set, see
+        # Data.begin.
+        self._users.begin()
+        try:
+            for m in pattern.finditer(data):
+                d = m.groupdict()
+                usr = self._users[d['handle']]
+                online.add(usr)
+                # tags is set by _set_tags, the raw string would make it look
+                # changed every time.
+                tags = d.pop('tags')
+                usr.update(d)
+                self._set_tags(usr, tags)
+                usr['online'] = True
 
-        # Lets make sure that all users are correctly set to offline too.
-        meantime_change = self._users.online.difference(online)
-        for user in meantime_change:
-            user['online'] = False
+            # Lets make sure that all users are correctly set to offline too.
+            # The users in online keep their items, so users that did not
+            # change do not trigger anything.
+            meantime_change = self._users.online.difference(online)
+            for user in meantime_change:
+                user['online'] = False
+            
+            self._users.online = online
+        finally:
+            self._users.commit()
         
-        self._users.online = online
-
-        self._icsbot.reg_comm(self.re_connect, self._connect)
-        self._icsbot.reg_comm(self.re_disconnect, self._disconnect)
+        if not self._listening:
+            self._icsbot.reg_comm(self.re_connect, self._connect)
+            self._icsbot.reg_comm(self.re_disconnect, self._disconnect)
+            self._listening = True
         
         self.status['got_all'] = True
         
@@ -102,8 +132,8 @@ class Status(object):
         d = matches.groupdict()
         usr = self._users[d['handle']]
         self._users.online.add(usr)
-        usr.items.update(d)
-        tags = d['tags']
+        tags = d.pop('tags')
+        usr.update(d)
         self._set_tags(usr, tags)
         usr['online'] = True
     
@@ -111,16 +141,17 @@ class Status(object):
     def _disconnect(self, matches):
         handle = matches.group('handle')
         usr = self._users[handle]
-        self._users.online.remove(usr)
+        # discard, with a shared users set, another bot may have done it.
+        self._users.online.discard(usr)
         usr['online'] = False
         
     
     def reset(self):
         """
-        Reset the status for when the bot disconnected. Note that the status
+        Get the who list again, ie. after the bot reconnected (it is
+        registered with icsbot.reg_reconnect). Users.online is kept until the
+        list came in, then only the changes are applied. Note that the status
         is only correct after who IA has been parsed. (as always true)
         """
-        self._icsbot.unreg_comm(self._connect)
-        self._icsbot.unreg_comm(self._disconnect)
-        self._users.online = set()
-        self.execute('who IbslwbzSLx', self._who_i)
+        self.status['got_all'] = False
+        self._icsbot.execute('who IbslwBzSLx', self._who_i)
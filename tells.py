@@ -92,7 +92,7 @@ class PrivateTells(object):
         return matches[0][1](usr, args, tags)
         
     
-    def register(self, command_str, function, priv=lambda *arg: True):
+    def register(self, command_str, function, priv=lambda *arg: True, offload=False):
         """Register a function to be executed when the command_str fits.
         register(string, function, [check]), where function is the
         actual command, and check is a function to check wether a user
@@ -100,13 +100,17 @@ class PrivateTells(object):
            function(user, arguments, tags)
            check(user)
         Where tags is just a string so that handle+tags looks like it should.
+        If offload is True, the function is run in a worker thread (see
+        IcsBot.offload).
         """
+        if offload:
+            function = self._icsbot.offload(function)
         self._registered[command_str.lower()] = (function, priv)
     
     
-    def decorate(self, command_str, priv=lambda *arg: True):
+    def decorate(self, command_str, priv=lambda *arg: True, offload=False):
         def newfunc(func):
-            self.register(command_str, func, priv)
+            self.register(command_str, func, priv, offload)
             return func
         return newfunc
     